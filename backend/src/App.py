@@ -1,3 +1,4 @@
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes import (
@@ -5,9 +6,14 @@ from routes import (
     UploadIllustrationRoute, 
     UploadReferenceRoute, 
     PreviewPDFRoute, 
-    BeginConversationRoute)
-from models import CustomerAgent, CodeAgent, ImageAnalysisAgent
+    CompileStatusRoute,
+    BeginConversationRoute,
+    StatsRoute)
+from models import ImageAnalysisAgent
 from database import DatabaseManager
+from sessions import SessionManager
+from utils.compile_queue import CompileQueue
+from detector.worker import KeypointWorker
 from openai import OpenAI
 
 app = FastAPI()
@@ -23,22 +29,47 @@ app.add_middleware(
 # Initialize shared components
 client = OpenAI()
 database = DatabaseManager()
-code_agent = CodeAgent(client, model="o1-2024-12-17")       # Use o1 for quality in code generation
-customer_agent = CustomerAgent(client, code_agent, database, model="gpt-4o")    # Use 4o for general conversation
-image_analysis_agent = ImageAnalysisAgent(client, model='o1-2024-12-17') 
+compile_queue = CompileQueue(max_workers=2)      # Max number of concurrent pdflatex builds
+# Customer and code agents are kept per (user, project) in the session manager
+sessions = SessionManager(client, database,
+                          chat_model="gpt-4o",              # Use 4o for general conversation
+                          code_model="o1-2024-12-17",       # Use o1 for quality in code generation
+                          compile_queue=compile_queue)
+# KEYPOINT_BACKEND selects the detector inference engine: eager, int8, torchscript, onnx or compile.
+# The detector runs in a worker process shared by all uploads, unless KEYPOINT_WORKER=0.
+keypoint_backend = os.environ.get("KEYPOINT_BACKEND", "eager")
+keypoint_worker = KeypointWorker(backend=keypoint_backend) if os.environ.get("KEYPOINT_WORKER", "1") != "0" else None
+image_analysis_agent = ImageAnalysisAgent(client, model='o1-2024-12-17', backend=keypoint_backend,
+                                          worker=keypoint_worker)
 
 # Instantiate route classes and include their routers
-chat_routes_instance = ChatRoutes(customer_agent, database)
-upload_illustration_instance = UploadIllustrationRoute(customer_agent, code_agent, image_analysis_agent, database)
-upload_reference_instance = UploadReferenceRoute(customer_agent, code_agent, database)
-preview_pdf_instance = PreviewPDFRoute()
-begin_conversation_instance = BeginConversationRoute(database, customer_agent)
+chat_routes_instance = ChatRoutes(sessions, database)
+upload_illustration_instance = UploadIllustrationRoute(sessions, image_analysis_agent, database)
+upload_reference_instance = UploadReferenceRoute(sessions, database)
+preview_pdf_instance = PreviewPDFRoute(compile_queue)
+compile_status_instance = CompileStatusRoute(compile_queue)
+begin_conversation_instance = BeginConversationRoute(database)
+stats_instance = StatsRoute(sessions)
 
 app.include_router(chat_routes_instance.router)
 app.include_router(upload_illustration_instance.router)
 app.include_router(upload_reference_instance.router)
 app.include_router(preview_pdf_instance.router)
+app.include_router(compile_status_instance.router)
 app.include_router(begin_conversation_instance.router)
+app.include_router(stats_instance.router)
+
+@app.on_event("startup")
+def startup():
+    # Load the keypoint detector (or start its worker) in the background, the server accepts requests in the meantime
+    image_analysis_agent.warmup()
+
+@app.on_event("shutdown")
+def shutdown():
+    # Write any chat messages still waiting in the background writer
+    database.close()
+    if keypoint_worker is not None:
+        keypoint_worker.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,18 +1,173 @@
-from supabase import create_client, Client
 from typing import Optional, List, Dict, Any
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from collections import deque, OrderedDict
+import bisect
+import re
 import base64
 import uuid
 import os
+import threading
+import time
+from storage import Storage, create_storage, TABLES
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class WriteBehindBuffer:
+    """
+    Batches inserts into multi-row requests written by a background thread.
+
+    Rows are written in the order they were queued, by a single writer, so the order of messages
+    within a project is kept. A batch is sent once max_batch rows are waiting, the oldest one
+    has waited max_delay seconds or a flush is requested. Failed requests are retried with
+    exponential backoff before the rows are dropped and logged.
+    """
+    def __init__(self, storage: Storage, max_batch=100, max_delay=0.2, max_retries=5, retry_delay=0.5):
+        self.storage = storage
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay      # First backoff in seconds, doubled on every retry
+        self._pending = deque()     # (table, row)
+        self._queued = 0            # Number of rows ever queued, put() returns it as the row's ticket
+        self._written = 0           # Number of rows ever written (or dropped), in queue order
+        self._flushing = 0          # Number of flush() calls waiting
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, table: str, row: Dict[str, Any]) -> int:
+        """Queue a row. Returns its ticket, to pass to flush()."""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer is closed")
+            self._pending.append((table, row))
+            self._queued += 1
+            self._condition.notify_all()
+            return self._queued
+
+    def flush(self, ticket: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """
+        Write pending rows now and wait until the row with the given ticket (default: every queued row)
+        has been written. Returns False on timeout.
+        """
+        with self._condition:
+            target = self._queued if ticket is None else ticket
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                return self._condition.wait_for(lambda: self._written >= target, timeout=timeout)
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        """Write the remaining rows and stop the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                # Give more rows a chance to arrive, bounded by max_delay, unless someone is waiting for them
+                self._condition.wait_for(lambda: len(self._pending) >= self.max_batch or self._closed or self._flushing,
+                                         timeout=self.max_delay)
+                batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+
+            # One request per run of consecutive rows for the same table, to keep the order
+            start = 0
+            while start < len(batch):
+                end = start
+                while end < len(batch) and batch[end][0] == batch[start][0]:
+                    end += 1
+                self._insert(batch[start][0], [row for _, row in batch[start:end]])
+                start = end
+
+            with self._condition:
+                self._written += len(batch)
+                self._condition.notify_all()
+
+    def _insert(self, table: str, rows: List[Dict[str, Any]]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.storage.insert(table, rows)
+                logger.info(f"Wrote {len(rows)} rows to {table}")
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Dropping {len(rows)} rows for {table} after {attempt + 1} attempts: {str(e)}\n{rows}")
+                    return
+                delay = self.retry_delay * 2**attempt
+                logger.warning(f"Error writing {len(rows)} rows to {table}, retrying in {delay}s: {str(e)}")
+                time.sleep(delay)
+
+# Rows become visible up to this many seconds after their created_at: created_at is set when a row is
+# queued, the write-behind buffer retries for about 16s, and servers' clocks may differ slightly
+MESSAGE_CURSOR_OVERLAP = 60
+
+def parse_timestamp(value: str) -> datetime:
+    """created_at as an aware datetime. PostgREST and SQLite format it differently, so it is not compared as text."""
+    # PostgREST drops trailing zeros of the microseconds, which fromisoformat only accepts from Python 3.11
+    value = re.sub(r'\.(\d+)', lambda match: '.' + match.group(1)[:6].ljust(6, '0'), value.replace('Z', '+00:00'))
+    timestamp = datetime.fromisoformat(value)
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+class ProjectMessages:
+    """
+    Cached messages of one project, in (created_at, id) order.
+
+    Ids are random UUIDs on Supabase, so they cannot serve as a cursor. The cursor is the newest
+    created_at seen, and the next fetch starts MESSAGE_CURSOR_OVERLAP seconds before it: a row that
+    lands after others but carries an earlier timestamp is fetched again within that window, and
+    rows that were already merged are skipped by id.
+    """
+    def __init__(self):
+        self.messages: List[Dict[str, Any]] = []
+        self.keys: List[tuple] = []     # (created_at, id) of each message
+        self.ids: set = set()
+        self.last_created_at: Optional[datetime] = None
+
+    @property
+    def since(self) -> Optional[str]:
+        """created_at to fetch from, None to fetch everything"""
+        if self.last_created_at is None:
+            return None
+        return (self.last_created_at - timedelta(seconds=MESSAGE_CURSOR_OVERLAP)).isoformat()
+
+    def merge(self, rows: List[Dict[str, Any]]):
+        """Add the rows not merged yet, at their (created_at, id) position"""
+        for row in rows:
+            if row['id'] in self.ids:
+                continue
+            self.ids.add(row['id'])
+            created_at = parse_timestamp(row['created_at'])
+            key = (created_at, str(row['id']))
+            # Nearly always the end of the list
+            position = bisect.bisect(self.keys, key)
+            self.keys.insert(position, key)
+            self.messages.insert(position, {'type': row['type'], 'content': row['content']})
+            if self.last_created_at is None or created_at > self.last_created_at:
+                self.last_created_at = created_at
+
 class DatabaseManager:
     _instance: Optional['DatabaseManager'] = None
-    _client: Optional[Client] = None
+    _storage: Optional[Storage] = None
+    _writer: Optional[WriteBehindBuffer] = None
+    _writer_lock = threading.Lock()
+    # Ticket of the last row queued for each project, see WriteBehindBuffer.flush
+    _project_tickets: Dict[str, int] = {}
+    _project_tickets_lock = threading.Lock()
+    # Read-through cache of get_project_messages, keyed on (project_id, user_id)
+    _message_cache: 'OrderedDict[tuple, ProjectMessages]' = OrderedDict()
+    _message_cache_lock = threading.Lock()
+    max_cached_projects = 256
     
     def __new__(cls) -> 'DatabaseManager':
         if cls._instance is None:
@@ -21,81 +176,145 @@ class DatabaseManager:
         return cls._instance
     
     def _initialize(self):
-        """Initialize the Supabase client if not already initialized"""
-        if self._client is None:
-            url = "https://qwnyotnopqbynarbtpsf.supabase.co"
-            # Use service role key for backend operations
-            key = "____"
-            self._client = create_client(url, key)
-            logger.info("Initialized Supabase client with service role")
+        """Initialize the storage engine if not already initialized, see storage.create_storage"""
+        if self._storage is None:
+            self._storage = create_storage()
 
     def test_connection(self):
         """Test the Supabase connection"""
         try:
             # Try a simple query to test the connection
-            self.client.table('messages').select('id').limit(1).execute()
+            self.storage.test_connection()
             logger.info("Database connection test successful")
         except Exception as e:
             logger.error(f"Database connection test failed: {str(e)}")
             raise
     
     @property
-    def client(self) -> Client:
-        """Get the Supabase client instance"""
-        if self._client is None:
+    def storage(self) -> Storage:
+        """Get the storage engine instance"""
+        if self._storage is None:
             self._initialize()
-        return self._client
+        return self._storage
 
     def save_message(self, content: str, message_type: str, project_id: str, user_id: str):
         """Save a message to the database"""
         try:
             logger.info(f"Saving message for project {project_id} and user {user_id}")
-            result = self.client.table('messages').insert({
+            result = self.storage.insert('messages', [{
                 'content': content,
                 'type': message_type,
                 'project_id': project_id,
                 'user_id': user_id
-            }).execute()
+            }])
             logger.info("Message saved successfully")
-            # Handle both list and .data responses
-            return result.data if hasattr(result, 'data') else result
+            return result
         except Exception as e:
             logger.error(f"Error saving message: {str(e)}")
             raise
 
+    @property
+    def writer(self) -> WriteBehindBuffer:
+        """Background writer for queue_message and queue_prompt, started on first use"""
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = WriteBehindBuffer(self.storage)
+            return self._writer
+
+    def queue_message(self, content: str, message_type: str, project_id: str, user_id: str):
+        """Queue a message to be saved in the background, see WriteBehindBuffer"""
+        logger.info(f"Queueing message for project {project_id} and user {user_id}")
+        # Set created_at now, rows written in one request would otherwise share the same timestamp
+        self._record_ticket(project_id, self.writer.put('messages', {
+            'content': content,
+            'type': message_type,
+            'project_id': project_id,
+            'user_id': user_id,
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }))
+
+    def queue_prompt(self, content: str, prompt_type: str, project_id: str, user_id: str):
+        """Queue a prompt to be saved in the background, see WriteBehindBuffer"""
+        logger.info(f"Queueing prompt for project {project_id}")
+        self._record_ticket(project_id, self.writer.put('prompts', {
+            'content': content,
+            'type': prompt_type,
+            'project_id': project_id,
+            'user_id': user_id,
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }))
+
+    def _record_ticket(self, project_id: str, ticket: int):
+        # Threads queueing for the same project may get here in either order, keep the newest ticket
+        with self._project_tickets_lock:
+            self._project_tickets[project_id] = max(self._project_tickets.get(project_id, 0), ticket)
+
+    def flush(self, project_id: Optional[str] = None, timeout: Optional[float] = None):
+        """Wait for the queued writes of a project (default: of all projects) to reach the database"""
+        if self._writer is None:
+            return
+        if project_id is None:
+            self._writer.flush(timeout=timeout)
+            return
+        with self._project_tickets_lock:
+            ticket = self._project_tickets.get(project_id)
+        if ticket is not None:
+            self._writer.flush(ticket, timeout=timeout)
+
+    def close(self):
+        """Write all queued rows and stop the background writer"""
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+
     def save_prompt(self, content: str, prompt_type: str, project_id: str, user_id: str):
         """Save a prompt to the database"""
         try:
             logger.info(f"Saving prompt for project {project_id}")
-            result = self.client.table('prompts').insert({
+            result = self.storage.insert('prompts', [{
                 'content': content,
                 'type': prompt_type,
                 'project_id': project_id,
                 'user_id': user_id
-            }).execute()
+            }])
             logger.info("Prompt saved successfully")
-            # Handle both list and .data responses
-            return result.data if hasattr(result, 'data') else result
+            return result
         except Exception as e:
             logger.error(f"Error saving prompt: {str(e)}")
             raise
 
     def get_project_messages(self, project_id: str, user_id: str) -> List[Dict[str, Any]]:
-        """Get all messages for a project in chronological order"""
+        """
+        Get all messages for a project in chronological order, as dicts with type and content.
+
+        Messages are cached per project, only rows from the last one seen onwards are fetched (see ProjectMessages).
+        """
         try:
-            logger.info(f"Fetching messages for project {project_id}")
-            response = self.client.table('messages')\
-                .select('*')\
-                .eq('project_id', project_id)\
-                .eq('user_id', user_id)\
-                .order('created_at', desc=False)\
-                .execute()
-            
-            # Handle both list and .data responses
-            messages = response.data if hasattr(response, 'data') else response
-            print(response)
+            # Make sure messages still waiting in the write-behind buffer are included
+            self.flush(project_id)
+            key = (project_id, user_id)
+            with self._message_cache_lock:
+                cached = self._message_cache.get(key)
+                if cached is None:
+                    cached = self._message_cache[key] = ProjectMessages()
+                self._message_cache.move_to_end(key)
+                while len(self._message_cache) > self.max_cached_projects:
+                    self._message_cache.popitem(last=False)
+                since = cached.since
+
+            logger.info(f"Fetching messages for project {project_id}" + (f" since {since}" if since else ""))
+            # id and created_at are only needed for the cursor and the order
+            rows = self.storage.fetch('messages', project_id, user_id, ['id', 'type', 'content', 'created_at'],
+                                      since=since)
+            with self._message_cache_lock:
+                cached.merge(rows or [])
+                messages = list(cached.messages)
             if messages:
-                logger.info(f"Found {len(messages)} messages")
+                logger.info(f"Found {len(messages)} messages ({len(rows or [])} fetched)")
                 return messages
             logger.info("No messages found")
             return []
@@ -107,14 +326,10 @@ class DatabaseManager:
         """Get all prompts for a project"""
         try:
             logger.info(f"Fetching prompts for project {project_id}")
-            result = self.client.table('prompts')\
-                .select('*')\
-                .eq('project_id', project_id)\
-                .eq('user_id', user_id)\
-                .execute()
-            logger.info(f"Found {len(result.data if hasattr(result, 'data') else result)} prompts")
-            # Handle both list and .data responses
-            return result.data if hasattr(result, 'data') else result
+            self.flush(project_id)
+            result = self.storage.fetch('prompts', project_id, user_id, ['id'] + TABLES['prompts'])
+            logger.info(f"Found {len(result)} prompts")
+            return result
         except Exception as e:
             logger.error(f"Error getting project prompts: {str(e)}")
             raise
@@ -1,15 +1,102 @@
+import os
+import itertools
 import torch
 from torch import nn
-from transformers import VitPoseForPoseEstimation
+from transformers import VitPoseConfig, VitPoseForPoseEstimation
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
 from loguru import logger
 
+BASE_MODEL = "usyd-community/vitpose-base-simple"
+# Inference-only weights, see save_inference_weights
+INFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inference")
+WEIGHTS_FILE = "model.safetensors"
+
 class ViTFashionDetector(nn.Module):
-    def __init__(self, num_labels=8):
+    def __init__(self, num_labels=8, pretrained=True, config=None):
         super().__init__()
-        self.model = VitPoseForPoseEstimation.from_pretrained("usyd-community/vitpose-base-simple")
+        if pretrained:
+            self.model = VitPoseForPoseEstimation.from_pretrained(BASE_MODEL)
+        else:
+            # Architecture only, for when all the weights are loaded afterwards
+            self.model = VitPoseForPoseEstimation(config or VitPoseConfig.from_pretrained(BASE_MODEL))
         self.model.head.conv = nn.Conv2d(
             self.model.config.backbone_config.hidden_size, num_labels, kernel_size=3, stride=1, padding=1
         )
-        
+
     def forward(self, x):
         return self.model(x)
+
+def save_inference_weights(checkpoint_path, output_dir=INFERENCE_DIR):
+    """
+    Write the model weights of a training checkpoint to output_dir/model.safetensors, along with the base
+    model's config.json. The optimizer and scheduler state is left out.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'), weights_only=False)
+    state_dict = {name: tensor.contiguous() for name, tensor in checkpoint['model_state_dict'].items()}
+    num_labels = state_dict["model.head.conv.weight"].shape[0]
+
+    os.makedirs(output_dir, exist_ok=True)
+    VitPoseConfig.from_pretrained(BASE_MODEL).save_pretrained(output_dir)
+    save_file(state_dict, os.path.join(output_dir, WEIGHTS_FILE),
+              metadata={"num_labels": str(num_labels), "checkpoint": os.path.basename(checkpoint_path)})
+    logger.info(f"Saved inference weights of {checkpoint_path} to {output_dir}")
+
+def load_inference_detector(weights_dir=INFERENCE_DIR, device=torch.device("cpu")):
+    """
+    Build a ViTFashionDetector from the files written by save_inference_weights.
+
+    The weights file is memory-mapped and the model is created on the meta device, so nothing is
+    randomly initialized or downloaded and no weights are copied before they are used.
+    """
+    weights_path = os.path.join(weights_dir, WEIGHTS_FILE)
+    with safe_open(weights_path, framework="pt") as file:
+        num_labels = int(file.metadata()["num_labels"])
+    config = VitPoseConfig.from_pretrained(weights_dir)
+    state_dict = load_file(weights_path, device=str(device))
+
+    with torch.device("meta"):
+        detector = ViTFashionDetector(num_labels, pretrained=False, config=config)
+    detector.load_state_dict(state_dict, assign=True)
+    if any(tensor.is_meta for tensor in itertools.chain(detector.parameters(), detector.buffers())):
+        # A buffer that is not part of the state dict was left uninitialized, build the model normally
+        detector = ViTFashionDetector(num_labels, pretrained=False, config=config).to(device)
+        detector.load_state_dict(state_dict)
+    return detector.eval()
+
+if __name__ == "__main__":
+    # Cold start of the detector, then CPU latency of batched inference: python detector/FashionDetector.py [checkpoint]
+    import sys
+    import tempfile
+    import time
+    torch.set_num_threads(os.cpu_count())
+    checkpoint_path = sys.argv[1] if len(sys.argv) > 1 else "./detector/checkpoint_epoch_30.pth"
+    if os.path.exists(checkpoint_path):
+        # Previous startup path: pretrained download/cache lookup, then the full training checkpoint
+        start = time.perf_counter()
+        model = ViTFashionDetector(num_labels=6)
+        model.load_state_dict(torch.load(checkpoint_path, map_location=torch.device('cpu'), weights_only=False)['model_state_dict'])
+        logger.info(f"from_pretrained + training checkpoint: {time.perf_counter() - start:.2f}s")
+
+        with tempfile.TemporaryDirectory() as weights_dir:
+            save_inference_weights(checkpoint_path, weights_dir)
+            start = time.perf_counter()
+            model = load_inference_detector(weights_dir)
+            logger.info(f"safetensors inference weights: {time.perf_counter() - start:.2f}s "
+                        f"({os.path.getsize(os.path.join(weights_dir, WEIGHTS_FILE))/1e6:.0f} MB vs "
+                        f"{os.path.getsize(checkpoint_path)/1e6:.0f} MB checkpoint)")
+    else:
+        logger.warning(f"{checkpoint_path} not found, skipping the cold start comparison")
+        model = ViTFashionDetector(num_labels=6)
+    model = model.eval()
+
+    with torch.inference_mode():
+        model(torch.randn([1,3,256,192]))    # Warm up
+        for batch_size in [1, 4, 16, 32]:
+            x = torch.randn([batch_size,3,256,192])
+            runs = max(1, 32 // batch_size)
+            start = time.perf_counter()
+            for _ in range(runs):
+                model(x)
+            elapsed = (time.perf_counter() - start) / (runs * batch_size)
+            logger.info(f"Batch size {batch_size}: {elapsed*1000:.1f} ms/image")
@@ -0,0 +1,202 @@
+import os
+import torch
+from torch import nn
+from loguru import logger
+from detector.FashionDetector import load_inference_detector, save_inference_weights, INFERENCE_DIR, WEIGHTS_FILE
+
+# Engines ImageAnalysisAgent can run the keypoint detector with, selected at startup
+BACKENDS = ["eager", "int8", "torchscript", "onnx", "compile"]
+# Detector input size (height, width)
+INPUT_SIZE = (256, 192)
+# Exported models are written here, next to the checkpoint they are exported from
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "exported")
+
+class HeatmapModel(nn.Module):
+    """Detector returning only the heatmaps tensor, the form the tracer and the ONNX exporter need."""
+    def __init__(self, detector):
+        super().__init__()
+        self.detector = detector
+
+    def forward(self, x):
+        return self.detector(x).heatmaps
+
+def example_input(detector):
+    """Random input on the detector's device, for tracing and exporting it."""
+    return torch.randn(1, 3, *INPUT_SIZE, device=next(detector.parameters()).device)
+
+def export_torchscript(detector, path):
+    """Trace the detector and save it as a frozen TorchScript module."""
+    model = HeatmapModel(detector).eval()
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example_input(detector), check_trace=False)
+        traced = torch.jit.freeze(traced)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    traced.save(path)
+    logger.info(f"Exported TorchScript keypoint detector to {path}")
+
+def export_onnx(detector, path, opset=17):
+    """Export the detector to ONNX with a dynamic batch dimension."""
+    model = HeatmapModel(detector).eval()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example_input(detector), path,
+            input_names=["pixel_values"], output_names=["heatmaps"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "heatmaps": {0: "batch"}},
+            opset_version=opset,
+        )
+    logger.info(f"Exported ONNX keypoint detector to {path}")
+
+class EagerEngine:
+    """The detector as is, in eager PyTorch."""
+    def __init__(self, detector, device):
+        self.model = HeatmapModel(detector).eval()
+        self.device = device
+
+    def __call__(self, x):
+        with torch.inference_mode():
+            return self.model(x.to(self.device)).cpu()
+
+class Int8Engine(EagerEngine):
+    """
+    The detector with its linear layers dynamically quantized to int8, on the CPU.
+
+    Weights are stored as int8 and activations are quantized on the fly, so no calibration data
+    is needed. Nearly all of the ViT backbone's weights and compute are in its linear layers.
+    """
+    def __init__(self, detector):
+        super().__init__(detector, torch.device("cpu"))
+        self.model = torch.ao.quantization.quantize_dynamic(self.model.cpu(), {nn.Linear}, dtype=torch.qint8)
+
+class CompileEngine(EagerEngine):
+    """The detector compiled with torch.compile. The first batch of every new size pays the compilation."""
+    def __init__(self, detector, device):
+        super().__init__(detector, device)
+        self.model = torch.compile(self.model, dynamic=True)
+
+class TorchScriptEngine:
+    """Frozen TorchScript module, optimized for inference when loaded."""
+    def __init__(self, path, device):
+        self.device = device
+        self.model = torch.jit.optimize_for_inference(torch.jit.load(path, map_location=device).eval())
+
+    def __call__(self, x):
+        with torch.inference_mode():
+            return self.model(x.to(self.device)).cpu()
+
+class OnnxEngine:
+    """ONNX Runtime session on the CPU."""
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or os.cpu_count()
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, x):
+        heatmaps, = self.session.run(["heatmaps"], {"pixel_values": x.detach().cpu().numpy()})
+        return torch.from_numpy(heatmaps)
+
+def is_stale(path, checkpoint_path):
+    """Whether an exported model is missing or older than the checkpoint it was exported from."""
+    if not os.path.exists(path):
+        return True
+    return checkpoint_path is not None and os.path.exists(checkpoint_path) \
+        and os.path.getmtime(path) < os.path.getmtime(checkpoint_path)
+
+def create_engine(detector, backend="eager", device=torch.device("cpu"), checkpoint_path=None, export_dir=EXPORT_DIR):
+    """
+    Wrap a loaded detector in the requested inference engine, exporting it first if needed.
+
+    An engine is called with a (B, 3, 256, 192) float tensor and returns the (B, K, 64, 48) heatmaps
+    on the CPU. Exports are reused until the checkpoint changes.
+
+    Args:
+        detector (ViTFashionDetector): Detector with its weights loaded.
+        backend (str): One of BACKENDS. int8, onnx and torchscript run on the CPU only.
+        checkpoint_path (str, optional): Checkpoint the weights came from, used to refresh stale exports.
+    """
+    assert backend in BACKENDS, f"backend must be one of {BACKENDS}"
+    detector.eval()
+    name = os.path.splitext(os.path.basename(checkpoint_path))[0] if checkpoint_path else "detector"
+    if backend == "torchscript":
+        path = os.path.join(export_dir, f"{name}.pt")
+        if is_stale(path, checkpoint_path):
+            export_torchscript(detector, path)
+        return TorchScriptEngine(path, device)
+    if backend == "onnx":
+        path = os.path.join(export_dir, f"{name}.onnx")
+        if is_stale(path, checkpoint_path):
+            export_onnx(detector, path)
+        return OnnxEngine(path)
+    if backend == "int8":
+        return Int8Engine(detector)
+    if backend == "compile":
+        return CompileEngine(detector, device)
+    return EagerEngine(detector, device)
+
+def load_engine(backend="eager", checkpoint_path=None, weights_dir=INFERENCE_DIR, device=torch.device("cpu")):
+    """
+    Build the detector engine from the slim inference weights (see FashionDetector.save_inference_weights),
+    which are first written from the training checkpoint if they are missing or older than it.
+    """
+    weights_path = os.path.join(weights_dir, WEIGHTS_FILE)
+    if is_stale(weights_path, checkpoint_path):
+        save_inference_weights(checkpoint_path, weights_dir)
+    detector = load_inference_detector(weights_dir, device)
+    return create_engine(detector, backend, device, weights_path)
+
+if __name__ == "__main__":
+    # Heatmap parity against eager mode and CPU latency of every backend:
+    #   python -m detector.engines [checkpoint] [backend ...]
+    import sys
+    import tempfile
+    import time
+    from detector.FashionDetector import ViTFashionDetector
+    from utils.keypoints import extract_keypoints_from_heatmaps
+    from utils.utils import load_checkpoint
+
+    checkpoint_path = sys.argv[1] if len(sys.argv) > 1 else "./detector/checkpoint_epoch_30.pth"
+    backends = sys.argv[2:] or BACKENDS
+    torch.manual_seed(0)
+    detector = ViTFashionDetector(num_labels=6).eval()
+    if os.path.exists(checkpoint_path):
+        load_checkpoint(checkpoint_path, detector)
+    else:
+        logger.warning(f"{checkpoint_path} not found, comparing backends on the untrained head")
+        checkpoint_path = None
+
+    x = torch.randn(8, 3, *INPUT_SIZE)
+    eager = EagerEngine(detector, torch.device("cpu"))
+    reference = eager(x)
+    reference_kpts = extract_keypoints_from_heatmaps(reference)
+    failed = False
+    with tempfile.TemporaryDirectory() as export_dir:
+        for backend in backends:
+            try:
+                engine = create_engine(detector, backend, checkpoint_path=checkpoint_path, export_dir=export_dir)
+                heatmaps = engine(x)
+            except Exception as e:
+                logger.warning(f"{backend}: unavailable ({e})")
+                continue
+
+            # Parity: heatmaps within float tolerance and the same argmax keypoints. int8 is approximate by
+            # design, it is only reported here, see finetune/eval_quantization.py for its accuracy
+            max_error = (heatmaps - reference).abs().max().item()
+            kpts_match = torch.equal(extract_keypoints_from_heatmaps(heatmaps), reference_kpts)
+            passed = backend == "int8" or (max_error < 1e-3 and kpts_match)
+            failed |= not passed
+            logger.info(f"{backend}: max heatmap error {max_error:.2e}, keypoints {'match' if kpts_match else 'DIFFER'} "
+                        f"-> {'PASS' if passed else 'FAIL'}")
+
+            for batch_size in [1, 8, 32]:
+                batch = torch.randn(batch_size, 3, *INPUT_SIZE)
+                engine(batch)    # Warm up
+                runs = max(2, 32 // batch_size)
+                start = time.perf_counter()
+                for _ in range(runs):
+                    engine(batch)
+                elapsed = time.perf_counter() - start
+                logger.info(f"{backend}, batch size {batch_size}: {elapsed/(runs*batch_size)*1000:.1f} ms/image, "
+                            f"{runs*batch_size/elapsed:.1f} images/s")
+    sys.exit(1 if failed else 0)
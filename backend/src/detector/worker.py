@@ -0,0 +1,184 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+import torch
+from loguru import logger
+from detector.FashionDetector import INFERENCE_DIR
+
+def _serve(requests, responses, backend, checkpoint_path, weights_dir, max_batch, max_wait, num_threads):
+    """
+    Worker process loop: load the detector once, then answer requests in dynamic batches.
+
+    After the first pending request arrives, more are collected for up to max_wait seconds or until
+    max_batch images are waiting, and all of them go through the detector in one forward pass.
+    """
+    from detector.engines import load_engine
+    from utils.keypoints import extract_keypoints_from_heatmaps
+    torch.set_num_threads(num_threads or os.cpu_count())
+    try:
+        engine = load_engine(backend, checkpoint_path, weights_dir)
+    except Exception as e:
+        logger.error(f"Keypoint worker failed to load the detector: {str(e)}")
+        responses.put((None, None, f"Keypoint worker failed to load the detector: {str(e)}"))
+        return
+    responses.put((None, None, None))   # Ready
+    logger.info(f"Keypoint worker ready ({backend})")
+
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        batch = [request]
+        size = len(request[1])
+        deadline = time.monotonic() + max_wait
+        while size < max_batch:
+            try:
+                request = requests.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request is None:
+                requests.put(None)      # Stop after this batch
+                break
+            batch.append(request)
+            size += len(request[1])
+
+        try:
+            x = torch.from_numpy(np.concatenate([images for _, images, _ in batch]))
+            heatmaps = torch.cat([engine(x[start:start+max_batch]) for start in range(0, len(x), max_batch)])
+            start = 0
+            for request_id, images, refine in batch:
+                # Keypoints in the 192x256 input space, the heatmaps are 4x smaller
+                kpts = extract_keypoints_from_heatmaps(heatmaps[start:start+len(images)], refine=refine)*4
+                responses.put((request_id, kpts.numpy(), None))
+                start += len(images)
+        except Exception as e:
+            logger.error(f"Keypoint worker failed on a batch of {size} images: {str(e)}")
+            for request_id, _, _ in batch:
+                responses.put((request_id, None, str(e)))
+
+class KeypointWorker:
+    """
+    Runs the keypoint detector in a separate process that holds the model once.
+
+    predict() can be called from any thread. Requests are sent over a local queue and batched by
+    the worker (see _serve), so concurrent uploads share forward passes, and the detector's compute
+    does not compete with the web server for the GIL. If the worker fails to load the detector or
+    exits, the requests waiting on it fail and the next predict() starts a new one.
+    """
+    def __init__(self, backend="eager", checkpoint_path="./detector/checkpoint_epoch_30.pth", weights_dir=INFERENCE_DIR,
+                 max_batch=32, max_wait=0.01, num_threads=None):
+        self.backend = backend
+        self.checkpoint_path = os.path.abspath(checkpoint_path)
+        self.weights_dir = weights_dir
+        self.max_batch = max_batch  # Max number of images per forward pass
+        self.max_wait = max_wait    # Seconds a request waits for others to join its batch
+        self.num_threads = num_threads
+        self._pending = {}          # request id -> Future
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._process = None
+        self._requests = None
+        self._ready = None          # Future set once the current process has loaded the detector
+
+    def start(self):
+        """
+        Start the worker process if it is not running. It loads the model in the background, predict() waits for it.
+
+        Returns:
+            tuple: The request queue and the ready future of the running process.
+        """
+        with self._lock:
+            if self._process is None:
+                # spawn: the worker must not inherit the web server's threads
+                context = multiprocessing.get_context("spawn")
+                self._requests = context.Queue()
+                responses = context.Queue()
+                self._ready = Future()
+                self._process = context.Process(
+                    target=_serve, name="keypoint-worker", daemon=True,
+                    args=(self._requests, responses, self.backend, self.checkpoint_path, self.weights_dir,
+                          self.max_batch, self.max_wait, self.num_threads),
+                )
+                self._process.start()
+                threading.Thread(target=self._receive, args=(self._process, responses, self._ready),
+                                 name="keypoint-responses", daemon=True).start()
+            return self._requests, self._ready
+
+    def predict(self, x, refine=None, timeout=120):
+        """
+        Detect keypoints on a batch of preprocessed images.
+
+        Args:
+            x (torch.Tensor): (B, 3, 256, 192) normalized images.
+            refine (str, optional): None, "quarter" or "dark" sub-pixel refinement.
+
+        Returns:
+            torch.Tensor: (B, K, 2) keypoints in the 192x256 input space.
+        """
+        requests, ready = self.start()
+        ready.result(timeout=timeout)
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        requests.put((request_id, x.numpy().astype(np.float32, copy=False), refine))
+        try:
+            return torch.from_numpy(future.result(timeout=timeout))
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    def _receive(self, process, responses, ready):
+        while True:
+            try:
+                request_id, kpts, error = responses.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    self._fail(process, ready, RuntimeError("Keypoint worker exited"))
+                    return
+                continue
+
+            if request_id is None:
+                # Startup message of the worker
+                if error is None:
+                    ready.set_result(True)
+                    continue
+                self._fail(process, ready, RuntimeError(error))
+                return
+            with self._lock:
+                future = self._pending.get(request_id)
+            if future is not None and not future.done():
+                if error is None:
+                    future.set_result(kpts)
+                else:
+                    future.set_exception(RuntimeError(error))
+
+    def _fail(self, process, ready, error):
+        """Fail everything waiting on process and forget it, so the next predict() starts a new one."""
+        with self._lock:
+            if self._process is process:
+                self._process = None
+            futures = list(self._pending.values())
+        if not ready.done():
+            ready.set_exception(error)
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
+
+    def close(self):
+        """Stop the worker process."""
+        with self._lock:
+            process, self._process = self._process, None
+        if process is not None:
+            self._requests.put(None)
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
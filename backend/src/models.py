@@ -10,21 +10,74 @@ import json
 import base64
 import os
 from utils.compile import compile_latex_from_txt
-from utils.utils import load_checkpoint, draw_keypoints, normalize_image, replace_between_markers, DEVICE
-from detector.FashionDetector import ViTFashionDetector
-from utils.keypoints import augment_upper_body_kpts, extract_keypoints_from_heatmap
+from utils.image_cache import image_cache, encode_jpeg, to_rgb, VISION_MAX_SIDE
+from utils.utils import draw_keypoints, normalize_image, log_duration, DEVICE
+from utils.template_sections import replace_sections, get_section_names
+from utils.history import HistoryWindow
+from detector.FashionDetector import INFERENCE_DIR
+from detector.engines import load_engine
+from utils.keypoints import augment_upper_body_kpts, extract_keypoints_from_heatmaps
 import torch
 import numpy as np
 from PIL import Image
-from utils.json_templates import ImageNamesTemplate, FilteredKeypointsTemplate, DrawingCodeTemplate, FullTemplate
-from io import BytesIO
-from utils.prompts import TEMPLATE
+from utils.json_templates import ImageNamesTemplate, FilteredKeypointsTemplate, DrawingCodeTemplate, FullTemplate, SectionEditsTemplate
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from utils.prompts import TEMPLATE, SECTION_EDIT_PROMPT
+
+def build_image_message(type, project_id):
+    """Build a user message holding all the images of the given type for a project, or None if there are none."""
+    assert type in ["illustration", "reference"], "type must be illustration or reference"
+    images_path = os.path.join(os.getcwd(), "projects", project_id, type)
+    
+    if not os.path.exists(images_path):
+        logger.warning(f"{type} directory does not exist: {images_path}")
+        return None
+        
+    image_names = os.listdir(images_path)
+    if not image_names:
+        logger.warning(f"No {type} images found in {images_path}")
+        return None
+        
+    images = [os.path.join(images_path, file) for file in image_names]
+
+    conv = {
+            "role": "user",
+            "content": [{
+                    "type": "text",
+                    "text": f"Here are the {type} image(s).\n\
+                            <REMEMBER THESE FILE NAMES EXACTLY>\n\
+                                The names of these {type} images are {[name for name in image_names]}. These come in the same order as the images.\n\
+                            </REMEMBER THESE FILE NAMES EXACTLY> ",
+                }]
+                }
+    
+    for image in images:
+        try:
+            conv["content"].append(
+                {
+                    "type": "image_url",
+                    "image_url": {"url": image_cache.get_data_url(image)},
+                }
+                )
+        except Exception as e:
+            logger.error(f"Error loading image {image}: {str(e)}")
+    
+    return conv
+
+# Max seconds a chat stream stays open waiting for the PDF build it queued
+COMPILE_WAIT_TIMEOUT = 180
 
 class CustomerAgent:
-    def __init__(self, client, code_agent, database, model="gpt-4o"):
+    def __init__(self, client, code_agent, database, model="gpt-4o", compile_queue=None, history_tokens=12000):
         self.__SYSTEM_PROMPT = SYSTEM_PROMPT_CUSTOMER_AGENT
         self.model = model
+        self.history_window = HistoryWindow(max_tokens=history_tokens)     # Token budget of the history sent each turn
         self.code_agent = code_agent
+        self.compile_queue = compile_queue      # Compile synchronously when None
         self.drawing_agent = DrawingSectionAgent(client, model='o1-2024-12-17')
         self.client = client
         self.database = database
@@ -53,80 +106,130 @@ class CustomerAgent:
 
             # Add user message to conversation history
             self.conv_history.append({"role":"user", "content": f"{user_message}"})
-            # Check for template generation first
-            function_completion = self.get_completion()
-            message = function_completion.choices[0].message
-
-            if message.function_call and message.function_call.name == "generate_template":
+            # Keep the prompt size flat as the conversation grows
+            self.conv_history = self.history_window.fit(self.conv_history)
+            # A single streaming completion: text deltas are forwarded as they arrive, a function call
+            # is accumulated from its deltas and dispatched once the stream ends
+            full_response = ""
+            function_name = None
+            function_arguments = ""
+            for chunk in self.get_completion(stream=True):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.function_call:
+                    function_name = delta.function_call.name or function_name
+                    function_arguments += delta.function_call.arguments or ""
+                elif delta.content:
+                    full_response += delta.content
+                    yield delta.content
+
+            if function_name == "generate_template":
                 logger.info("Generating Template")
-                # Non-streaming path for function calls
-                response, code = self.get_response(message)
-                
-                compilation_result = None
-                if code:
-                    # Ensure project directory exists
-                    proj_dir = os.path.join(os.getcwd(), 'projects', project_id)
-                    os.makedirs(proj_dir, exist_ok=True)
-                    
-                    # Write LaTeX code to file
-                    code_txt_path = os.path.join(proj_dir, "code.txt")
-                    logger.info(f"Writing LaTeX code to {code_txt_path}")
-                    
-                    with open(code_txt_path, "w") as file:
-                        file.write(code)
-                    
-                    # Verify the file was written correctly
-                    if not os.path.exists(code_txt_path) or os.path.getsize(code_txt_path) == 0:
-                        logger.error(f"Failed to write LaTeX code to {code_txt_path}")
-                        response += "\n\nThere was an issue generating your tech pack. The system couldn't save the LaTeX code properly."
+                # Non-streaming path for function calls. The template is generated on a worker thread
+                # so that progress events (dicts) can be yielded while it runs.
+                start = time.perf_counter()
+                message = SimpleNamespace(content=full_response or None,
+                                          function_call=SimpleNamespace(name=function_name, arguments=function_arguments))
+                events = queue.Queue()
+
+                def generate():
+                    response, code = self.get_response(message, events.put)
+                    return self.save_template(response, code, project_id, events.put)
+
+                executor = ThreadPoolExecutor(max_workers=1)
+                try:
+                    future = executor.submit(generate)
+                    future.add_done_callback(lambda _: events.put(None))
+                    for event in iter(events.get, None):
+                        yield event
+                    assistant_message, compile_generation = future.result()
+                finally:
+                    # If the client disconnects, the stream is closed at a yield. The task still writes
+                    # code.txt, queues the build and records the reply in the history, without blocking the close.
+                    executor.shutdown(wait=False)
+                yield assistant_message["content"]
+
+                if compile_generation is not None:
+                    # The response is already out, keep the stream open until the PDF is ready
+                    compile_start = time.perf_counter()
+                    status = self.compile_queue.wait(project_id, compile_generation, timeout=COMPILE_WAIT_TIMEOUT)
+                    # A later build may have finished too, it compiled the same or newer code
+                    if status["built"] < compile_generation:
+                        compile_status = status["state"]
                     else:
-                        logger.info(f"Compiling LaTeX code at {code_txt_path}")
-                        current_dir = os.path.dirname(os.path.abspath(__file__))
-                        compilation_result = self.compile_latex(os.path.join(current_dir, "projects"), project_id)
-                        
-                        # Add compilation result feedback to response
-                        if compilation_result:
-                            response += "\n\nYour tech pack has been updated and a new PDF has been generated. You can view it using the 'Tech Pack Preview' button."
-                        else:
-                            response += "\n\nThere was an issue generating your tech pack PDF. The system team has been notified."
-                
-                self.conv_history.append({"role":"assistant", "content":f"{response}"})
-                yield response
+                        compile_status = "finished" if status["succeeded"] else "failed"
+                    yield {"stage": "compiling", "status": compile_status,
+                           "seconds": round(time.perf_counter() - compile_start, 3)}
+                    if compile_status == "failed":
+                        failure = "\n\nThere was an issue generating your tech pack PDF. The system team has been notified."
+                        assistant_message["content"] += failure
+                        yield failure
+                yield {"stage": "done", "status": "finished", "seconds": round(time.perf_counter() - start, 3),
+                       "timings": {stage: round(seconds, 3) for stage, seconds in self.code_agent.last_timings.items()}}
             else:
-                # For regular messages, use streaming
-                streaming_completion = self.client.chat.completions.create(
-                    model=self.model,
-                    temperature=0.7,
-                    messages=self.conv_history,
-                    stream=True
-                )
-                
-                # Collect the full response to add to history later
-                full_response = ""
-                
-                # Process the streaming response
-                for chunk in streaming_completion:
-                    if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
-                        content = chunk.choices[0].delta.content
-                        if content:
-                            full_response += content
-                            yield content
-
-                # Save the complete response to conversation history
+                # Regular message, already streamed. Save the complete response to conversation history
                 self.conv_history.append({"role":"assistant", "content":f"{full_response}"})
                 
         except Exception as e:
             logger.error(f"Error in chat_stream: {str(e)}")
             yield f"Error: {str(e)}"
     
-    def get_completion(self):
+    def save_template(self, response, code, project_id, on_progress):
+        """
+        Write the generated template to the project's code.txt, compile it and add the reply to the conversation history.
+
+        Returns:
+            tuple: The assistant message added to the history, and the compile generation to wait for
+                (None when nothing was queued).
+        """
+        compile_generation = None
+        if code:
+            # Ensure project directory exists
+            proj_dir = os.path.join(os.getcwd(), 'projects', project_id)
+            os.makedirs(proj_dir, exist_ok=True)
+            
+            # Write LaTeX code to file
+            code_txt_path = os.path.join(proj_dir, "code.txt")
+            logger.info(f"Writing LaTeX code to {code_txt_path}")
+            
+            with open(code_txt_path, "w") as file:
+                file.write(code)
+            
+            # Verify the file was written correctly
+            if not os.path.exists(code_txt_path) or os.path.getsize(code_txt_path) == 0:
+                logger.error(f"Failed to write LaTeX code to {code_txt_path}")
+                response += "\n\nThere was an issue generating your tech pack. The system couldn't save the LaTeX code properly."
+            elif self.compile_queue is not None:
+                # Compile in the background, /preview_pdf waits for the build
+                logger.info(f"Queueing LaTeX compilation of {code_txt_path}")
+                compile_generation = self.compile_queue.submit(project_id, proj_dir)
+                on_progress({"stage": "compiling", "status": "started"})
+                response += "\n\nYour tech pack has been updated and a new PDF is being generated. You can view it using the 'Tech Pack Preview' button."
+            else:
+                logger.info(f"Compiling LaTeX code at {code_txt_path}")
+                current_dir = os.path.dirname(os.path.abspath(__file__))
+                with log_duration("compiling", on_progress=on_progress):
+                    compilation_result = self.compile_latex(os.path.join(current_dir, "projects"), project_id)
+                
+                # Add compilation result feedback to response
+                if compilation_result:
+                    response += "\n\nYour tech pack has been updated and a new PDF has been generated. You can view it using the 'Tech Pack Preview' button."
+                else:
+                    response += "\n\nThere was an issue generating your tech pack PDF. The system team has been notified."
+
+        assistant_message = {"role":"assistant", "content":f"{response}"}
+        self.conv_history.append(assistant_message)
+        return assistant_message, compile_generation
+
+    def get_completion(self, stream=False):
         completion = self.client.chat.completions.create(
             model=self.model,
             temperature=0.7,
             messages=self.conv_history,
             functions=self.functions,
             function_call="auto",
-            stream=False
+            stream=stream
         )
 
         return completion
@@ -167,13 +270,13 @@ class CustomerAgent:
             logger.error(f"Error loading conversation history: {str(e)}")
             raise
 
-    def get_response(self, message):
+    def get_response(self, message, on_progress=None):
         code = None
         # Check if code generation is needed
         if message.function_call and message.function_call.name == "generate_template":
             # Generate code
             args = json.loads(message.function_call.arguments)
-            code = self.code_agent.generate_template(args["context"])
+            code = self.code_agent.generate_template(args["context"], on_progress)
             # Add code generation result to history
             self.conv_history.append(
                 {"role": "developer", "content": "You just generated a tech pack, tell this to the user."}
@@ -198,45 +301,9 @@ class CustomerAgent:
                 ]
         
     def load_image(self, type, project_id):
-        assert type in ["illustration", "reference"], "type must be illustration or reference"
-        images_path = os.path.join(os.getcwd(), "projects", project_id, type)
-        
-        if not os.path.exists(images_path):
-            logger.warning(f"{type} directory does not exist: {images_path}")
-            return
-            
-        image_names = os.listdir(images_path)
-        if not image_names:
-            logger.warning(f"No {type} images found in {images_path}")
-            return
-            
-        images = [os.path.join(images_path, file) for file in image_names]
-
-        conv = {
-                "role": "user",
-                "content": [{
-                        "type": "text",
-                        "text": f"Here are the {type} image(s).\n\
-                            <REMEMBER THESE FILE NAMES EXACTLY>\n\
-                                The names of these {type} images are {[name for name in image_names]}. These come in the same order as the images.\n\
-                            </REMEMBER THESE FILE NAMES EXACTLY> ",
-                    }]
-                    }
-        
-        for image in images:
-            try:
-                with open(image, "rb") as image_file:
-                    image_data = base64.b64encode(image_file.read()).decode("utf-8")
-                conv["content"].append(
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
-                    }
-                    )
-            except Exception as e:
-                logger.error(f"Error loading image {image}: {str(e)}")
-        
-        self.conv_history.append(conv)
+        conv = build_image_message(type, project_id)
+        if conv is not None:
+            self.conv_history.append(conv)
 
     def compile_latex(self, project_path, project_id):
         """
@@ -275,6 +342,7 @@ class CodeAgent:
         self.combine_sections_agent = CombinedSectionsAgent(client, model="o1-2024-12-17")
         self.client = client
         self.current_template = TEMPLATE
+        self.last_timings = {}      # Seconds spent in each stage of the last generate_template call
         self.conv_history =[
             {"role": "developer", "content": self.__SYSTEM_PROMPT},     # Provide general instructions and tasks
             ]
@@ -294,43 +362,100 @@ class CodeAgent:
         }
          }]
     
-    def generate_template(self, context):
+    def generate_template(self, context, on_progress=None):
+        """
+        Generate the new template for the request described in context.
+
+        Args:
+            context (str): Description of the user's request from the customer agent.
+            on_progress (callable, optional): Called with a progress event dict when a stage
+                (deciding, drawing, templating, combining) starts or finishes.
+        """
         self.conv_history.append({"role":"user", "content": f"{context}"})
         self.conv_history_analyze_context.append({"role":"user", "content": f"{context}"})
+        timings = {}
 
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=self.conv_history_analyze_context,
-            reasoning_effort="high",
-            functions=self.functions,
-            function_call="auto",
-            stream=False)
-        
-        self.reset_conv_history_analyze_context()
+        def analyze_context():
+            with log_duration("deciding", timings, on_progress):
+                return self.client.chat.completions.create(
+                    model=self.model,
+                    messages=self.conv_history_analyze_context,
+                    reasoning_effort="high",
+                    functions=self.functions,
+                    function_call="auto",
+                    stream=False)
+
+        def edit_template():
+            with log_duration("templating", timings, on_progress):
+                return self.edit_template()
+
+        with log_duration("generate_template", timings):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                # The template request does not depend on the drawing decision, so it runs
+                # alongside the decision and, if needed, the drawing agent.
+                template_future = executor.submit(edit_template)
+                response = analyze_context()
+                self.reset_conv_history_analyze_context()
+
+                code_blocks = None
+                message = response.choices[0].message
+                if message.function_call and message.function_call.name == "generate_drawing_section":
+                    logger.info("Generating Drawing Section")
+                    with log_duration("drawing", timings, on_progress):
+                        code_blocks = self.drawing_agent.generate_drawing_section()
+
+                new_template = template_future.result()
+
+            if code_blocks is not None:
+                logger.info("Combining sections")
+                with log_duration("combining", timings, on_progress):
+                    new_template = self.combine_sections_agent.combine_sections(new_template, code_blocks)
+            self.conv_history.append({"role":"assistant", "content":f"Here is the new template:\n{new_template}"})
+
+        self.current_template = new_template
+        self.last_timings = timings
+
+        return new_template
+    
+    def edit_template(self):
+        """
+        Apply the latest request to the current template. Only the sections that change are regenerated
+        and spliced into the current template, the whole template is only regenerated when the current
+        one has lost its section markers or the model asks for a section that does not exist.
+        """
+        section_names = [name for name in get_section_names(self.current_template) if name != "DRAWING_SECTION"]
+        if section_names:
+            # The drawing section is generated by the drawing agent
+            response = self.client.beta.chat.completions.parse(
+                model=self.model,
+                messages=self.conv_history + [{"role": "developer", "content": SECTION_EDIT_PROMPT.format(section_names=section_names)}],
+                reasoning_effort="high",
+                response_format=SectionEditsTemplate,
+            )
+            parsed = response.choices[0].message.parsed
+            edits = {edit.name: edit.code.strip("\n") for edit in parsed.sections}
+            unknown = [name for name in edits if name not in section_names]
+            if parsed.full_template:
+                logger.info("The request changes code outside the sections")
+            elif not unknown:
+                logger.info(f"Regenerating sections {list(edits)}")
+                return replace_sections(self.current_template, edits)
+            else:
+                logger.warning(f"Unknown sections {unknown}, regenerating the whole template")
 
+        logger.info("Regenerating the whole template")
         response_template = self.client.chat.completions.create(
             model=self.model,
             messages=self.conv_history,
             reasoning_effort="high",
             stream=False)
-        
-        message = response.choices[0].message
-        if message.function_call.name == "generate_drawing_section":
-            logger.info("Generating Drawing Section")
-            code_blocks = self.drawing_agent.generate_drawing_section()
-            logger.info("Generating Remaining Tech Pack")
-            logger.info("Combining sections")
-            new_template = self.combine_sections_agent.combine_sections(response_template.choices[0].message.content, code_blocks)
-            self.conv_history.append({"role":"assistant", "content":f"Here is the new tempalte:\n{new_template}"})
-        else:
-            logger.info("Editing template")
-            new_template = response_template.choices[0].message.content
-            self.conv_history.append({"role":"assistant", "content":f"Here is the new template:\n{new_template}"})
+        return response_template.choices[0].message.content
 
-        self.current_template = new_template
+    def load_template(self, template):
+        """Continue from a previously generated template, e.g. a project's code.txt."""
+        self.current_template = template
+        self.conv_history.append({"role":"assistant", "content":f"Here is the current template:\n{template}"})
 
-        return new_template
-    
     def reset_conv_history_analyze_context(self):
             self.conv_history_analyze_context = [
             {'role':"developer", "content": "You will be given some information about a user request for a tech pack. Based on this information, decide if it is necessary to create the FRONT VIEW or BACK VIEW sections. If yes, Call the generate_drawing_section function."}
@@ -338,20 +463,50 @@ class CodeAgent:
 
     
 class ImageAnalysisAgent:
-    def __init__(self, client, model="gpt-4o-2024-08-06"):
+    def __init__(self, client, model="gpt-4o-2024-08-06", batch_size=16, keypoint_refinement=None, max_concurrency=4,
+                 backend="eager", checkpoint_path="./detector/checkpoint_epoch_30.pth", weights_dir=INFERENCE_DIR, worker=None):
         self.__SYSTEM_PROMPT_CLASSIFICATION = SYSTEM_PROMPT_IMAGE_ANALYSIS_AGENT_CLASSIFICATION
         self.__SYSTEM_PROMPT_SELECTION = SYSTEM_PROMPT_IMAGE_ANALYSIS_AGENT_SELECTION
         self.model = model
-        self.kpt_detector = ViTFashionDetector(num_labels=6).to(DEVICE)
-        load_checkpoint("./detector/checkpoint_epoch_30.pth", self.kpt_detector)
+        self.batch_size = batch_size      # Max number of images per detector forward pass
+        self.keypoint_refinement = keypoint_refinement    # None, "quarter" or "dark" sub-pixel refinement
+        self.max_concurrency = max_concurrency    # Max number of concurrent keypoint selection requests
+        # Inference engine for the detector: eager, int8, torchscript, onnx or compile, see detector/engines.py.
+        # It is built on first use or by warmup(), so the detector does not delay startup.
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path
+        self.weights_dir = weights_dir
+        self._kpt_engine = None
+        self._kpt_engine_lock = threading.Lock()
+        # Optional detector.worker.KeypointWorker, which runs the detector in its own process instead
+        self.worker = worker
         self.client = client
         self.conv_history_classification =[
             {"role": "developer", "content": self.__SYSTEM_PROMPT_CLASSIFICATION},     # Provide general instructions and tasks
             ]
-        self.conv_history_selection =[
-        {"role": "developer", "content": self.__SYSTEM_PROMPT_SELECTION},     # Provide general instructions and tasks
-        ]
     
+    @property
+    def kpt_engine(self):
+        with self._kpt_engine_lock:
+            if self._kpt_engine is None:
+                self._kpt_engine = self.load_detector()
+            return self._kpt_engine
+
+    def load_detector(self):
+        """
+        Build the detector engine, see detector.engines.load_engine. Only the engine is kept, so the
+        fp32 weights are freed when it holds its own copy (int8, exports).
+        """
+        with log_duration("loading keypoint detector"):
+            return load_engine(self.backend, self.checkpoint_path, self.weights_dir, DEVICE)
+
+    def warmup(self):
+        """Build the detector engine on a background thread (or start the worker), ahead of the first illustration upload."""
+        if self.worker is not None:
+            self.worker.start()
+        else:
+            threading.Thread(target=lambda: self.kpt_engine, name="kpt-warmup", daemon=True).start()
+
     def analyze_images(self, img_folder_path):
         img_names = os.listdir(img_folder_path)
         imgs = [os.path.join(img_folder_path, name) for name in img_names]
@@ -370,19 +525,18 @@ class ImageAnalysisAgent:
         }
             
         for img in imgs:
-            with open(img, "rb") as image_file:
-                encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-            
             conv["content"].append({
                 "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"},
+                "image_url": {"url": image_cache.get_data_url(img)},
             })
 
-        self.conv_history_classification.append(conv)
+        # Every call gets its own history, uploads of several projects can be analyzed at once
+        conv_history_classification = self.new_classification_history()
+        conv_history_classification.append(conv)
 
         response = self.client.beta.chat.completions.parse(
             model=self.model,
-            messages=self.conv_history_classification,
+            messages=conv_history_classification,
             response_format=ImageNamesTemplate,
         )
 
@@ -391,95 +545,142 @@ class ImageAnalysisAgent:
         imgs_with_kpts, kpts = self.detect_keypoints(img_folder_path, image_names)
         logger.info("Filtering Relevant Keypoints...")
         self.filter_keypoints(imgs_with_kpts, img_folder_path, image_names, kpts)
-        self.reset_conv_history()   # Delete conversation history to start with a blank slate after detection.
     
     def detect_keypoints(self, img_folder_path, img_names, save=False):
         img_paths = [os.path.join(img_folder_path, name) for name in img_names]  
         images = [Image.open(img_path) for img_path in img_paths]
+        if not images:
+            return [], []
+
+        batch_kpts = augment_upper_body_kpts(self.predict_keypoints(images))
+        # Rescale from the 192x256 detector input back to each original (W, H)
+        sizes = torch.tensor([image.size for image in images], dtype=torch.float32)
+        batch_kpts = batch_kpts*(sizes/torch.tensor([192.0, 256.0])).unsqueeze(1)
+
         new_images = []
         detected_kpts = []
         for idx, image in enumerate(images):
-            W, H = image.size
-            resized_img = image.resize([192,256])
-            normalized_image = normalize_image(resized_img)
-            x = torch.tensor(normalized_image).permute(2,0,1).unsqueeze(0).float()
-            with torch.no_grad():
-                out = self.kpt_detector(x)
-            kpts = extract_keypoints_from_heatmap(out['heatmaps'][0])
-            kpts_list = []
-            for kp in kpts:
-                kpts_list.append([kp[0], kp[1]])
-
-            kpts = torch.tensor(kpts_list)*4
-            kpts = augment_upper_body_kpts(kpts)
-            kpts[:,0] = kpts[:,0]*(W/192)
-            kpts[:,1] = kpts[:,1]*(H/256)
-
-            new_image = draw_keypoints(np.array(image), kpts)
+            kpts = batch_kpts[idx]
+            # Draw on a preview sized for the vision model, so the labels stay legible after downscaling
+            new_image = draw_keypoints(np.array(to_rgb(image)), kpts, in_place=True, max_side=VISION_MAX_SIDE)
             new_images.append(Image.fromarray(new_image))
             detected_kpts.append(kpts)
 
             if save:
-                Image.fromarray(new_image).save(img_paths[idx])
+                Image.fromarray(draw_keypoints(np.array(image), kpts, in_place=True)).save(img_paths[idx])
 
         return new_images, detected_kpts
 
+    def preprocess(self, images):
+        """Resize and normalize PIL images into a single (N, 3, 256, 192) detector input."""
+        return torch.stack([
+            torch.tensor(normalize_image(image.resize([192,256]))).permute(2,0,1).float()
+            for image in images
+        ])
+
+    def predict_keypoints(self, images):
+        """
+        Detect the keypoints of a list of PIL images, on the worker process when there is one.
+
+        Returns:
+            torch.Tensor: Keypoints of shape (N, K, 2) in the 192x256 detector input space.
+        """
+        if self.worker is not None:
+            return self.worker.predict(self.preprocess(images), refine=self.keypoint_refinement)
+        heatmaps = self.predict_heatmaps(images)
+        # The heatmaps are 4x smaller than the detector input
+        return extract_keypoints_from_heatmaps(heatmaps, refine=self.keypoint_refinement)*4
+
+    def predict_heatmaps(self, images):
+        """
+        Run the keypoint detector on a list of PIL images in this process.
+
+        All images are resized and normalized up front and stacked into a single tensor,
+        which is then passed through the detector in micro-batches of self.batch_size.
+
+        Returns:
+            torch.Tensor: Heatmaps of shape (N, K, 64, 48) on the CPU.
+        """
+        x = self.preprocess(images)
+
+        heatmaps = []
+        for start in range(0, x.shape[0], self.batch_size):
+            heatmaps.append(self.kpt_engine(x[start:start+self.batch_size]))
+
+        return torch.cat(heatmaps, dim=0)
+
     def filter_keypoints(self, imgs_with_kpts, img_folder_path, image_names, kpts):
+        """
+        Filter the keypoints of every image, running up to self.max_concurrency selection requests at once.
+
+        Returns:
+            list: The kept keypoints for each image, in the order of image_names (None where filtering failed).
+        """
         img_paths = [os.path.join(img_folder_path, name) for name in image_names]
-        for idx, img in enumerate(imgs_with_kpts):
-            buffer = BytesIO()
-            img.save(buffer, format=img.format or "PNG")
-            encoded_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        tasks = list(zip(imgs_with_kpts, img_paths, image_names, kpts))
+        if not tasks:
+            return []
 
-            conv = {
-            "role": "user",''
-            "content": [{
-                "type": "text",
-                "text": (
-                    "Here is the image with green keypoints painted on it.\n"
-                    )
-                }]
-            }
-            conv["content"].append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"},
-            })
-            self.conv_history_selection.append(conv)
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(tasks))) as executor:
+            return list(executor.map(lambda task: self.filter_image_keypoints(*task), tasks))
 
-            response = self.client.beta.chat.completions.parse(
-                model=self.model,
-                messages=self.conv_history_selection,
-                response_format=FilteredKeypointsTemplate,
-            )
+    def filter_image_keypoints(self, img, img_path, image_name, kpts):
+        """Select the relevant keypoints of a single image and save the original image with only those drawn on it."""
+        encoded_image = base64.b64encode(encode_jpeg(img)).decode("utf-8")
 
-            filtered_kpt_inds = response.choices[0].message.parsed.filtered_kpts
-            filtered_kpt_inds = [ind-1 for ind in filtered_kpt_inds]
-            logger.info(filtered_kpt_inds)
-            try:
-                filtered_kpts = kpts[idx][filtered_kpt_inds]
-            except Exception as e:
-                logger.info(e)
-                continue
-            
-            original_img = Image.open(img_paths[idx])
-            new_image = draw_keypoints(np.array(original_img), filtered_kpts)
-            Image.fromarray(new_image).save(img_paths[idx])
-            self.reset_selection_history()
-            logger.info(f"Filtered and saved {image_names[idx]} with {len(filtered_kpts)} keypoints.")
+        conv = {
+        "role": "user",''
+        "content": [{
+            "type": "text",
+            "text": (
+                "Here is the image with green keypoints painted on it.\n"
+                )
+            }]
+        }
+        conv["content"].append({
+            "type": "image_url",
+            "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"},
+        })
+        # Every image gets its own history so the requests are independent of each other
+        conv_history_selection = self.new_selection_history()
+        conv_history_selection.append(conv)
+
+        response = self.client.beta.chat.completions.parse(
+            model=self.model,
+            messages=conv_history_selection,
+            response_format=FilteredKeypointsTemplate,
+        )
+
+        filtered_kpt_inds = response.choices[0].message.parsed.filtered_kpts
+        filtered_kpt_inds = [ind-1 for ind in filtered_kpt_inds]
+        logger.info(f"{image_name}: {filtered_kpt_inds}")
+        try:
+            filtered_kpts = kpts[filtered_kpt_inds]
+        except Exception as e:
+            logger.info(e)
+            return None
+        
+        original_img = Image.open(img_path)
+        new_image = draw_keypoints(np.array(original_img), filtered_kpts, in_place=True)
+        Image.fromarray(new_image).save(img_path)
+        logger.info(f"Filtered and saved {image_name} with {len(filtered_kpts)} keypoints.")
+        return filtered_kpts
             
     def reset_classification_history(self):
-        self.conv_history_classification = [
-            {"role": "developer", "content": self.__SYSTEM_PROMPT_CLASSIFICATION},     # Provide general instructions and tasks
-            ]
+        self.conv_history_classification = self.new_classification_history()
+
+    def new_classification_history(self):
+        return [
+        {"role": "developer", "content": self.__SYSTEM_PROMPT_CLASSIFICATION},     # Provide general instructions and tasks
+        ]
         
-    def reset_selection_history(self):
-        self.conv_history_selection = [
+    def new_selection_history(self):
+        return [
         {"role": "developer", "content": self.__SYSTEM_PROMPT_SELECTION},     # Provide general instructions and tasks
         ]
 
     def reset_conv_history(self):
         self.reset_classification_history()
-        self.reset_selection_history()
 
 
 class DrawingSectionAgent:
@@ -554,13 +755,6 @@ class CombinedSectionsAgent:
     #     return response.choices[0].message.parsed.template_code
 
     def combine_sections(self, current_template, code_blocks):
-        drawing_code = ""
-        for block in code_blocks:
-            drawing_code += f"{block}\n"
-        
-        template = replace_between_markers(current_template,
-                                           "%%START_DRAWING_SECTION%%",
-                                           "%%END_DRAWING_SECTION%%",
-                                           drawing_code)
+        drawing_code = "".join(f"{block}\n" for block in code_blocks)
 
-        return template
\ No newline at end of file
+        return replace_sections(current_template, {"DRAWING_SECTION": drawing_code})
\ No newline at end of file
@@ -1,19 +1,51 @@
 from fastapi import APIRouter, Request, HTTPException, UploadFile, File, Form
 from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import json
 import os
-import base64
+import threading
 import werkzeug
 from loguru import logger
 import torch
+from utils.image_cache import image_cache
+from utils.compile import get_build_cache_stats
+
+# Sentinel queued when a chat stream is exhausted
+_STREAM_END = object()
 
 class ChatRoutes:
-    def __init__(self, model, database):
+    def __init__(self, sessions, database, max_workers=64):
         self.router = APIRouter()
-        self.model = model
+        self.sessions = sessions
         self.database = database
+        # chat_stream makes blocking OpenAI, Supabase and pdflatex calls, so streams run on this
+        # pool instead of the event loop (see run_stream), letting concurrent chats overlap.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat")
         self.setup_routes()
 
+    def run_stream(self, loop, session, message, project_id, user_id, chunks, cancelled):
+        """
+        Run a chat stream on the pool, handing its chunks to the event loop through chunks.
+
+        The session's chat lock is held until the stream is closed, so concurrent requests for the same
+        project take turns instead of running its agents at the same time. If the client goes away
+        (cancelled), the stream is closed at its next chunk, still holding the lock.
+        """
+        with session.chat_lock:
+            stream = session.customer_agent.chat_stream(message, project_id, user_id)
+            try:
+                for chunk in stream:
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+            finally:
+                stream.close()
+                loop.call_soon_threadsafe(chunks.put_nowait, _STREAM_END)
+
     def setup_routes(self):
         @self.router.post("/chat")
         async def chat(request: Request):
@@ -23,21 +55,39 @@ class ChatRoutes:
             user_id = data.get("userId", "")
 
             async def generate():
+                loop = asyncio.get_running_loop()
+                cancelled = threading.Event()
                 try:
-                    # Save user message to database first
-                    self.database.save_message(message, "user", project_id, user_id)
+                    # Save user message to database first, written in the background
+                    self.database.queue_message(message, "user", project_id, user_id)
                     
+                    session = await loop.run_in_executor(self.executor, self.sessions.get, user_id, project_id)
                     response_content = ""
-                    # Assuming chat_stream is synchronous; if async, await appropriately
-                    for chunk in self.model.chat_stream(message, project_id, user_id):
+                    chunks = asyncio.Queue()
+                    loop.run_in_executor(self.executor, self.run_stream, loop, session, message, project_id, user_id,
+                                         chunks, cancelled)
+                    while True:
+                        chunk = await chunks.get()
+                        if chunk is _STREAM_END:
+                            break
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        if isinstance(chunk, dict):
+                            # Progress event of the tech pack generation pipeline
+                            yield f"data: {json.dumps({'progress': chunk})}\n\n"
+                            continue
                         response_content += chunk
                         yield f"data: {json.dumps({'content': chunk})}\n\n"
                     
-                    # Save the complete response to database after streaming
-                    self.database.save_message(response_content, "assistant", project_id, user_id)
+                    # Save the complete response to database after streaming. The client reloads the
+                    # messages once the stream is done, so make sure they are written by then.
+                    self.database.queue_message(response_content, "assistant", project_id, user_id)
+                    await loop.run_in_executor(self.executor, self.database.flush, project_id, 5)
                     yield f"data: {json.dumps({'done': True})}\n\n"
                 except Exception as e:
                     yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                finally:
+                    cancelled.set()
 
             return StreamingResponse(generate(), media_type="text/event-stream", headers={
                 "Cache-Control": "no-cache",
@@ -47,10 +97,9 @@ class ChatRoutes:
             })
 
 class UploadIllustrationRoute:
-    def __init__(self, customer_agent, code_agent, image_agent, database):
+    def __init__(self, sessions, image_agent, database):
         self.router = APIRouter()
-        self.customer_agent = customer_agent
-        self.code_agent = code_agent
+        self.sessions = sessions
         self.image_agent = image_agent
         self.database = database
         self.setup_routes()
@@ -66,6 +115,9 @@ class UploadIllustrationRoute:
             if not images:
                 return JSONResponse({"error": "No image part in the request"}, status_code=400)
             
+            # Look up the session before saving, so a newly created one does not load these images twice
+            session = await run_in_threadpool(self.sessions.get, userId, projectId)
+            
             conv = {
                 "role": "user",
                 "content": [{
@@ -91,33 +143,29 @@ class UploadIllustrationRoute:
                     content = await image.read()
                     buffer.write(content)
 
-            # Analyze the images
-            self.image_agent.analyze_images(upload_folder)
+            # Analyze the images, off the event loop
+            await run_in_threadpool(self.image_agent.analyze_images, upload_folder)
 
             # Append the filtred imaged
             for image in images:
                 filename = werkzeug.utils.secure_filename(image.filename)
                 upload_folder = os.path.join(os.getcwd(), f'projects/{projectId}/illustration')
                 file_path = os.path.join(upload_folder, filename)
-                with open(file_path, "rb") as image_file:
-                    encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-                
                 conv["content"].append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"},
+                    "image_url": {"url": await run_in_threadpool(image_cache.get_data_url, file_path)},
                 })
                 
-            self.customer_agent.conv_history.append(conv)
-            self.code_agent.conv_history.append(conv)
-            self.code_agent.drawing_agent.conv_history.append(conv)
+            session.customer_agent.conv_history.append(conv)
+            session.code_agent.conv_history.append(conv)
+            session.code_agent.drawing_agent.conv_history.append(conv)
             
             return {"message": "File uploaded successfully"}
 
 class UploadReferenceRoute:
-    def __init__(self, customer_agent, code_agent, database):
+    def __init__(self, sessions, database):
         self.router = APIRouter()
-        self.customer_agent = customer_agent
-        self.code_agent = code_agent
+        self.sessions = sessions
         self.database = database
         self.setup_routes()
 
@@ -132,6 +180,9 @@ class UploadReferenceRoute:
             if not images:
                 return JSONResponse({"error": "No image part in the request"}, status_code=400)
             
+            # Look up the session before saving, so a newly created one does not load these images twice
+            session = await run_in_threadpool(self.sessions.get, userId, projectId)
+            
             conv = {
                 "role": "user",
                 "content": [{
@@ -157,20 +208,19 @@ class UploadReferenceRoute:
                     content = await image.read()
                     buffer.write(content)
                 
-                with open(file_path, "rb") as image_file:
-                    encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-                
                 conv["content"].append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"},
+                    "image_url": {"url": await run_in_threadpool(image_cache.get_data_url, file_path)},
                 })
-                self.code_agent.conv_history.append(conv)
+                session.code_agent.conv_history.append(conv)
             
             return {"message": "File uploaded successfully"}
 
 class PreviewPDFRoute:
-    def __init__(self):
+    def __init__(self, compile_queue, wait_timeout=180):
         self.router = APIRouter()
+        self.compile_queue = compile_queue
+        self.wait_timeout = wait_timeout      # Max seconds to wait for a pending build before serving the last PDF
         self.setup_routes()
 
     def setup_routes(self):
@@ -186,6 +236,11 @@ class PreviewPDFRoute:
             if not project_id:
                 return JSONResponse({"error": "projectId is required"}, status_code=400)
             
+            # Serve the newest build, waiting for it if one is queued or running
+            status = await run_in_threadpool(self.compile_queue.wait, project_id, None, self.wait_timeout)
+            if status["state"] in ["queued", "running"]:
+                logger.warning(f"Timed out waiting for build of project {project_id}, serving the previous PDF")
+            
             pdf_folder = os.path.join(os.getcwd(), f'projects/{project_id}')
             if not os.path.exists(pdf_folder):
                 return JSONResponse({"error": f"Project folder not found: {pdf_folder}"}, status_code=404)
@@ -226,11 +281,21 @@ class PreviewPDFRoute:
             
             return FileResponse(newest_pdf_path, media_type="application/pdf", filename=filename)
 
+class CompileStatusRoute:
+    def __init__(self, compile_queue):
+        self.router = APIRouter()
+        self.compile_queue = compile_queue
+        self.setup_routes()
+
+    def setup_routes(self):
+        @self.router.get("/compile_status")
+        async def compile_status(projectId: str):
+            return self.compile_queue.status(projectId)
+
 class BeginConversationRoute:
-    def __init__(self, database, customer_agent):
+    def __init__(self, database):
         self.router = APIRouter()
         self.database = database
-        self.customer_agent = customer_agent
         self.setup_routes()
 
     def setup_routes(self):
@@ -238,9 +303,24 @@ class BeginConversationRoute:
         async def begin_conversation(userId: str = Form(...), projectId: str = Form(...)):
             logger.info("Conversation Initialized")
 
-            self.database.save_message(
+            self.database.queue_message(
                 "Thank you for uploading your illustration and reference images! To get started, please provide your brand name and designer name.",
                 "assistant", projectId, userId
             )
             return {"message": "Conversation initialized"}
         
+
+class StatsRoute:
+    def __init__(self, sessions):
+        self.router = APIRouter()
+        self.sessions = sessions
+        self.setup_routes()
+
+    def setup_routes(self):
+        @self.router.get("/stats")
+        async def stats():
+            return {
+                "sessions": self.sessions.stats(),
+                "image_cache": image_cache.stats(),
+                "build_cache": get_build_cache_stats(),
+            }
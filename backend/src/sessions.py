@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from loguru import logger
+import os
+import threading
+import time
+from concurrent.futures import Future
+from models import CustomerAgent, CodeAgent, build_image_message
+
+class ProjectSession:
+    """Agent state belonging to a single (user, project) pair."""
+    def __init__(self, client, database, user_id, project_id, chat_model, code_model, compile_queue=None):
+        self.user_id = user_id
+        self.project_id = project_id
+        # Held for the duration of a chat stream, the agents keep per-conversation state
+        self.chat_lock = threading.Lock()
+        self.code_agent = CodeAgent(client, model=code_model)
+        self.customer_agent = CustomerAgent(client, self.code_agent, database, model=chat_model,
+                                            compile_queue=compile_queue)
+        self.last_used = time.monotonic()
+        self.load_images()
+        self.load_template()
+
+    def load_images(self):
+        """Give the code and drawing agents the images already uploaded to the project."""
+        for type in ["illustration", "reference"]:
+            conv = build_image_message(type, self.project_id)
+            if conv is None:
+                continue
+            self.code_agent.conv_history.append(conv)
+            if type == "illustration":
+                self.code_agent.drawing_agent.conv_history.append(conv)
+
+    def load_template(self):
+        """Continue from the project's last generated template, if there is one."""
+        code_txt_path = os.path.join(os.getcwd(), "projects", self.project_id, "code.txt")
+        if os.path.exists(code_txt_path):
+            with open(code_txt_path, "r") as file:
+                self.code_agent.load_template(file.read())
+
+class SessionManager:
+    """
+    Bounded LRU cache of ProjectSessions keyed on (user_id, project_id).
+
+    Sessions that have not been used for idle_timeout seconds, or that fall off the end of
+    the LRU once more than max_sessions are alive, are dropped and rebuilt from the
+    database on their next request.
+    """
+    def __init__(self, client, database, chat_model="gpt-4o", code_model="o1-2024-12-17",
+                 compile_queue=None, max_sessions=128, idle_timeout=30*60):
+        self.client = client
+        self.database = database
+        self.compile_queue = compile_queue
+        self.chat_model = chat_model
+        self.code_model = code_model
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+        self._building = {}     # key -> Future of a session being built
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id, project_id):
+        """
+        Return the session for (user_id, project_id), creating it if needed.
+
+        A session is built outside the lock, since it reads the project's files and images, so requests
+        for other projects are not held up. Concurrent requests for the same key wait for the same build.
+        """
+        key = (user_id, project_id)
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(key)
+            if session is not None:
+                self.hits += 1
+                self._sessions.move_to_end(key)
+                session.last_used = time.monotonic()
+                return session
+
+            future = self._building.get(key)
+            if future is None:
+                self.misses += 1
+                future = self._building[key] = Future()
+                building = True
+            else:
+                self.hits += 1
+                building = False
+
+        if not building:
+            return future.result()
+
+        try:
+            session = ProjectSession(self.client, self.database, user_id, project_id,
+                                     self.chat_model, self.code_model, self.compile_queue)
+        except Exception as e:
+            with self._lock:
+                del self._building[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._building[key]
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_sessions:
+                evicted_key, _ = self._sessions.popitem(last=False)
+                self.evictions += 1
+                logger.info(f"Evicted session for project {evicted_key[1]} (LRU)")
+        future.set_result(session)
+        return session
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        # Sessions are ordered by last use, so idle ones are at the front
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if now - session.last_used < self.idle_timeout:
+                break
+            del self._sessions[key]
+            self.evictions += 1
+            logger.info(f"Evicted session for project {key[1]} (idle)")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
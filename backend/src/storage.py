@@ -0,0 +1,188 @@
+from abc import ABC, abstractmethod
+from typing import Optional, List, Dict, Any
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import logging
+import os
+import queue
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# Tables used by DatabaseManager, with the columns every row has besides id
+TABLES = {
+    'messages': ['content', 'type', 'project_id', 'user_id', 'created_at'],
+    'prompts': ['content', 'type', 'project_id', 'user_id', 'created_at'],
+}
+
+class Storage(ABC):
+    """
+    Interface of the storage engines behind DatabaseManager.
+
+    Rows are plain dicts. fetch returns rows in (created_at, id) order.
+    """
+    @abstractmethod
+    def insert(self, table: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert rows in a single request and return the inserted rows, with their id"""
+
+    @abstractmethod
+    def fetch(self, table: str, project_id: str, user_id: str, columns: List[str],
+              since: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Rows of a project, only those with created_at >= since when given"""
+
+    @abstractmethod
+    def test_connection(self):
+        """Raise if the storage cannot be reached"""
+
+    def close(self):
+        pass
+
+class SupabaseStorage(Storage):
+    """Storage in the hosted Supabase (PostgREST) database"""
+    def __init__(self, url: str, key: str):
+        from supabase import create_client
+        self.client = create_client(url, key)
+        logger.info("Initialized Supabase client with service role")
+
+    def insert(self, table, rows):
+        result = self.client.table(table).insert(rows).execute()
+        # Handle both list and .data responses
+        return result.data if hasattr(result, 'data') else result
+
+    def fetch(self, table, project_id, user_id, columns, since=None):
+        query = self.client.table(table)\
+            .select(', '.join(columns))\
+            .eq('project_id', project_id)\
+            .eq('user_id', user_id)
+        if since is not None:
+            query = query.gte('created_at', since)
+        result = query\
+            .order('created_at', desc=False)\
+            .order('id', desc=False)\
+            .execute()
+        return (result.data if hasattr(result, 'data') else result) or []
+
+    def test_connection(self):
+        self.client.table('messages').select('id').limit(1).execute()
+
+class SQLiteStorage(Storage):
+    """
+    Local storage in a SQLite file, for offline runs and load testing without a network.
+
+    The database runs in WAL mode so readers do not block the writer. Connections are kept in a
+    pool of pool_size, a request waits for a free connection instead of opening a new one.
+    """
+    def __init__(self, path: str, pool_size: int = 8):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self._connection() as connection:
+            for table, columns in TABLES.items():
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    + ", ".join(f"{column} TEXT" for column in columns) + ")"
+                )
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{table}_project ON {table} (project_id, user_id, created_at)"
+                )
+        logger.info(f"Initialized SQLite storage at {path}")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @contextmanager
+    def _connection(self):
+        connection = self._pool.get()
+        try:
+            yield connection
+        finally:
+            self._pool.put(connection)
+
+    def insert(self, table, rows):
+        columns = TABLES[table]
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [{**row, 'created_at': row.get('created_at') or now} for row in rows]
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+        inserted = []
+        with self._connection() as connection:
+            # One transaction for the whole batch. AUTOINCREMENT never reuses the ids of deleted rows,
+            # so the ids are read back from each insert rather than computed
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for row in rows:
+                    cursor = connection.execute(sql, tuple(row.get(column) for column in columns))
+                    inserted.append({'id': cursor.lastrowid, **row})
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return inserted
+
+    def fetch(self, table, project_id, user_id, columns, since=None):
+        for column in columns:
+            if column != 'id' and column not in TABLES[table]:
+                raise ValueError(f"Unknown column {column} in {table}")
+        sql = f"SELECT {', '.join(columns)} FROM {table} WHERE project_id = ? AND user_id = ?"
+        params = [project_id, user_id]
+        if since is not None:
+            sql += " AND created_at >= ?"
+            params.append(since)
+        sql += " ORDER BY created_at, id"
+        with self._connection() as connection:
+            return [dict(row) for row in connection.execute(sql, params)]
+
+    def test_connection(self):
+        with self._connection() as connection:
+            connection.execute("SELECT id FROM messages LIMIT 1")
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get().close()
+
+def create_storage() -> Storage:
+    """
+    Create the storage engine selected by the environment.
+
+    TECHPACK_STORAGE=sqlite stores everything in TECHPACK_SQLITE_PATH (default projects/techpack.db),
+    anything else uses Supabase at SUPABASE_URL with SUPABASE_KEY.
+    """
+    if os.environ.get("TECHPACK_STORAGE", "supabase").lower() == "sqlite":
+        return SQLiteStorage(os.environ.get("TECHPACK_SQLITE_PATH", os.path.join(os.getcwd(), "projects", "techpack.db")))
+    url = os.environ.get("SUPABASE_URL", "https://qwnyotnopqbynarbtpsf.supabase.co")
+    # Use service role key for backend operations
+    key = os.environ.get("SUPABASE_KEY", "____")
+    return SupabaseStorage(url, key)
+
+if __name__ == "__main__":
+    # Write and read throughput of the SQLite engine: python storage.py
+    import tempfile
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    logging.basicConfig(level=logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(os.path.join(tmp, "bench.db"))
+        projects = [f"project-{i}" for i in range(100)]
+
+        start = time.perf_counter()
+        for _ in range(100):
+            storage.insert('messages', [{'content': "x" * 500, 'type': "user", 'project_id': project, 'user_id': "user"}
+                                        for project in projects])
+        elapsed = time.perf_counter() - start
+        logger.info(f"insert: {10000/elapsed:.0f} rows/s in batches of {len(projects)}")
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            fetched = sum(len(rows) for rows in executor.map(
+                lambda project: storage.fetch('messages', project, "user", ['id', 'type', 'content', 'created_at']),
+                projects * 10
+            ))
+        elapsed = time.perf_counter() - start
+        logger.info(f"fetch: {len(projects)*10/elapsed:.0f} project histories/s ({fetched/elapsed:.0f} rows/s), 8 threads")
+        storage.close()
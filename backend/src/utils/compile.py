@@ -2,6 +2,24 @@ import os
 import subprocess
 import logging
 import shutil
+import hashlib
+import threading
+import re
+
+# Precompiled preamble formats, shared by all projects
+FORMAT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "latex_formats")
+# Least recently used formats beyond this number are deleted
+MAX_FORMATS = 8
+# Ends the dumped part of the preamble, the rest is run on every pass. The \csname form is \relax
+# when the document is compiled without a format
+END_OF_DUMP = "\\csname endofdump\\endcsname\n"
+
+# Project folders whose images are part of the build cache key
+IMAGE_DIRS = ["illustration", "reference"]
+BUILD_KEY_FILE = ".build_key"
+
+build_cache_stats = {"hits": 0, "misses": 0}
+_build_cache_lock = threading.Lock()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,12 +32,153 @@ def find_latex_txt_file(directory):
             return os.path.join(directory, file)
     return None
 
-def compile_latex_from_txt(project_dir):
+def file_digest(path):
+    """SHA-256 of a file's content, or None if it does not exist."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def normalize_latex(latex_content):
+    """Normalize whitespace that does not change the typeset output: runs of spaces, indentation and repeated blank lines."""
+    lines = [" ".join(line.split()) for line in latex_content.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+def compute_build_key(project_dir, latex_content):
+    """Hash of the normalized LaTeX source and of every image in the project's image folders."""
+    key = hashlib.sha256(normalize_latex(latex_content).encode("utf-8"))
+    for folder in IMAGE_DIRS:
+        folder_path = os.path.join(project_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for name in sorted(os.listdir(folder_path)):
+            path = os.path.join(folder_path, name)
+            if os.path.isfile(path):
+                key.update(f"{folder}/{name}:{file_digest(path)}\n".encode("utf-8"))
+    return key.hexdigest()
+
+def record_build_cache(hit):
+    with _build_cache_lock:
+        build_cache_stats["hits" if hit else "misses"] += 1
+
+def get_build_cache_stats():
+    with _build_cache_lock:
+        lookups = build_cache_stats["hits"] + build_cache_stats["misses"]
+        return {**build_cache_stats, "hit_rate": build_cache_stats["hits"] / lookups if lookups else 0.0}
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def run_pdflatex(tex_file_path, project_dir, fmt_path, label):
+    """Run one pdflatex pass, optionally from a precompiled format, and append its output to compile.log."""
+    command = ["pdflatex", "-interaction=nonstopmode", "-output-directory", project_dir]
+    if fmt_path:
+        command.append(f"-fmt={os.path.splitext(fmt_path)[0]}")
+    result = subprocess.run(
+        command + [tex_file_path],
+        cwd=project_dir,
+        check=False,
+        capture_output=True,
+        text=True
+    )
+
+    # Log the output for debugging
+    with open(os.path.join(project_dir, "compile.log"), "a") as log_file:
+        log_file.write(f"=== {label} ===\n")
+        log_file.write(result.stdout)
+        log_file.write(result.stderr)
+
+    return result
+
+def find_dump_end(latex_content):
+    """
+    Position where the static part of the preamble ends: the first section marker before \\begin{document},
+    since sections such as HEADER_FOOTER hold the project's brand name, or \\begin{document} itself.
+    Returns -1 if the document has no \\begin{document}.
+    """
+    marker = latex_content.find("\\begin{document}")
+    if marker == -1:
+        return -1
+    section = latex_content.find("%%START_", 0, marker)
+    return section if section != -1 else marker
+
+def add_end_of_dump(latex_content):
+    """Insert END_OF_DUMP where the static part of the preamble ends, see find_dump_end."""
+    dump_end = find_dump_end(latex_content)
+    if dump_end == -1 or latex_content.startswith("\\begin{document}", dump_end):
+        return latex_content
+    return latex_content[:dump_end] + END_OF_DUMP + latex_content[dump_end:]
+
+def prune_formats(keep):
+    """Delete the least recently used formats in FORMAT_DIR beyond MAX_FORMATS, never the one in keep."""
+    try:
+        paths = [os.path.join(FORMAT_DIR, name) for name in os.listdir(FORMAT_DIR) if name.endswith(".fmt")]
+        paths.sort(key=os.path.getmtime, reverse=True)
+    except OSError:
+        return
+    for path in paths[MAX_FORMATS:]:
+        if path != keep:
+            logger.info(f"Removing unused preamble format {path}")
+            remove_file(path)
+
+def get_preamble_format(latex_content, tex_file_path, project_dir):
+    """
+    Returns the path of a pdflatex format with the static part of the document's preamble already loaded,
+    building it with mylatexformat if needed. Formats are keyed on the hash of that part only (see
+    find_dump_end) and shared by all projects, so the packages in templates/template.tex are only processed
+    once instead of on every pass. The .tex file must have been written with add_end_of_dump.
+
+    Returns:
+        str: Path to the .fmt file, or None if the format could not be built.
+    """
+    dump_end = find_dump_end(latex_content)
+    if dump_end == -1:
+        return None
+    preamble_hash = hashlib.sha256(latex_content[:dump_end].encode("utf-8")).hexdigest()[:16]
+    fmt_path = os.path.join(FORMAT_DIR, preamble_hash + ".fmt")
+    if os.path.exists(fmt_path):
+        try:
+            os.utime(fmt_path)     # Most recently used, see prune_formats
+        except FileNotFoundError:
+            pass
+        else:
+            return fmt_path
+
+    os.makedirs(FORMAT_DIR, exist_ok=True)
+    # Build under a unique job name so concurrent builds of the same preamble do not clash
+    jobname = f"{preamble_hash}-{os.getpid()}-{threading.get_ident()}"
+    logger.info(f"Building preamble format {fmt_path}")
+    result = subprocess.run(
+        ["pdflatex", "-ini", "-interaction=nonstopmode", f"-jobname={jobname}", "-output-directory", FORMAT_DIR,
+         "&pdflatex", "mylatexformat.ltx", tex_file_path],
+        cwd=project_dir,
+        check=False,
+        capture_output=True,
+        text=True
+    )
+    for ext in [".log", ".aux"]:
+        remove_file(os.path.join(FORMAT_DIR, jobname + ext))
+
+    built_path = os.path.join(FORMAT_DIR, jobname + ".fmt")
+    if result.returncode != 0 or not os.path.exists(built_path):
+        logger.warning("Could not build preamble format, compiling without it")
+        remove_file(built_path)
+        return None
+    os.replace(built_path, fmt_path)
+    prune_formats(keep=fmt_path)
+    return fmt_path
+
+def compile_latex_from_txt(project_dir, use_format=True, use_cache=True):
     """
     Converts a .txt LaTeX file to .tex and compiles it into a PDF using MacTeX.
     
     Parameters:
         project_dir (str): The directory containing the LaTeX .txt file and other assets.
+        use_format (bool): Load the preamble from a cached precompiled format (see get_preamble_format).
+        use_cache (bool): Reuse the existing tech_pack.pdf if the source and images are unchanged since it was built.
     
     Returns:
         str: Path to the generated PDF file, or None if compilation fails.
@@ -50,10 +209,22 @@ def compile_latex_from_txt(project_dir):
         # The standard name we want to use for all tech pack PDFs
         final_pdf_path = os.path.join(project_dir, "tech_pack.pdf")
 
+        # Skip the build if the PDF was made from the same source and images
+        build_key = compute_build_key(project_dir, latex_content)
+        build_key_path = os.path.join(project_dir, BUILD_KEY_FILE)
+        if use_cache and os.path.exists(final_pdf_path) and os.path.exists(build_key_path):
+            with open(build_key_path, 'r') as key_file:
+                if key_file.read() == build_key:
+                    record_build_cache(hit=True)
+                    logger.info(f"✅ Source unchanged, reusing {final_pdf_path}")
+                    return final_pdf_path
+        record_build_cache(hit=False)
+        remove_file(build_key_path)
+
         # Write the content to a .tex file
         logger.info(f"Writing LaTeX content to {tex_file_path}")
         with open(tex_file_path, 'w') as tex_file:
-            tex_file.write(latex_content)
+            tex_file.write(add_end_of_dump(latex_content) if use_format else latex_content)
 
         # Verify .tex file was written correctly
         if not os.path.exists(tex_file_path) or os.path.getsize(tex_file_path) == 0:
@@ -61,27 +232,30 @@ def compile_latex_from_txt(project_dir):
             return None
 
         try:
-            # Run pdflatex twice to resolve references
+            fmt_path = get_preamble_format(latex_content, tex_file_path, project_dir) if use_format else None
+
+            # Run pdflatex a second time only if the first pass changed the references in the .aux file
+            aux_path = os.path.join(project_dir, base_name + ".aux")
+            remove_file(output_pdf_path)    # So a stale PDF is never mistaken for this build's output
             for i in range(2):
+                aux_before = file_digest(aux_path)
                 logger.info(f"Running pdflatex compilation pass {i+1}")
-                result = subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", "-output-directory", project_dir, tex_file_path],
-                    cwd=project_dir,
-                    check=False,
-                    capture_output=True,
-                    text=True
-                )
-                
-                # Log the output for debugging
-                with open(os.path.join(project_dir, "compile.log"), "a") as log_file:
-                    log_file.write(f"=== Compilation Pass {i+1} ===\n")
-                    log_file.write(result.stdout)
-                    log_file.write(result.stderr)
+                run_pdflatex(tex_file_path, project_dir, fmt_path, f"Compilation Pass {i+1}")
+
+                if i == 0 and fmt_path and not os.path.exists(output_pdf_path):
+                    # Some preambles do not survive being dumped, fall back to a regular compile
+                    logger.warning(f"Compilation with format {fmt_path} failed, retrying without it")
+                    remove_file(fmt_path)
+                    fmt_path = None
+                    run_pdflatex(tex_file_path, project_dir, None, f"Compilation Pass {i+1} (no format)")
                 
                 # Check for biber references on first pass
                 bib_files = [f for f in os.listdir(project_dir) if f.endswith(".bib")]
                 if i == 0 and bib_files:
                     subprocess.run(["biber", base_name], cwd=project_dir, check=False)
+                elif file_digest(aux_path) == aux_before:
+                    logger.info("References unchanged, skipping further passes")
+                    break
 
             # Check if PDF was created, regardless of compilation errors
             if os.path.exists(output_pdf_path):
@@ -90,6 +264,8 @@ def compile_latex_from_txt(project_dir):
                 if os.path.exists(final_pdf_path):
                     os.remove(final_pdf_path)
                 os.rename(output_pdf_path, final_pdf_path)
+                with open(build_key_path, 'w') as key_file:
+                    key_file.write(build_key)
                 return final_pdf_path
             else:
                 logger.error(f"❌ Expected PDF not found: {output_pdf_path}")
@@ -106,8 +282,19 @@ def compile_latex_from_txt(project_dir):
     return None
 
 
-#current_dir = os.path.dirname(os.path.abspath(__file__))
-#project_folder = os.path.join(current_dir, "project")
-
-# Compile LaTeX document
-#pdf_path = compile_latex_from_txt(project_folder)
+if __name__ == "__main__":
+    # Wall time per compile with and without the preamble format: python utils/compile.py
+    import tempfile
+    import time
+    template_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates", "template.tex")
+    with open(template_path, "r", encoding="utf-8") as f:
+        template = f.read()
+    for use_format in [False, True]:
+        with tempfile.TemporaryDirectory() as project_dir:
+            with open(os.path.join(project_dir, "code.txt"), "w") as f:
+                f.write(template)
+            compile_latex_from_txt(project_dir, use_format, use_cache=False)     # Warm up, builds the format if needed
+            start = time.perf_counter()
+            for _ in range(3):
+                compile_latex_from_txt(project_dir, use_format, use_cache=False)
+            logger.info(f"use_format={use_format}: {(time.perf_counter() - start)/3:.2f}s per compile")
@@ -0,0 +1,100 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from utils.compile import compile_latex_from_txt
+
+class ProjectBuild:
+    """Build bookkeeping for one project. Generations count calls to CompileQueue.submit."""
+    def __init__(self, project_dir):
+        self.project_dir = project_dir
+        self.requested = 0      # Latest generation submitted
+        self.built = 0          # Latest generation whose build has finished
+        self.queued = False
+        self.running = False
+        self.pdf_path = None    # Result of the last finished build
+
+    @property
+    def state(self):
+        if self.running:
+            return "running"
+        if self.queued:
+            return "queued"
+        if self.built == 0:
+            return "idle"
+        return "done" if self.pdf_path else "failed"
+
+class CompileQueue:
+    """
+    Compiles projects' code.txt on a bounded pool of workers, so at most max_workers pdflatex runs happen at once.
+
+    Redundant jobs are collapsed: a project has at most one build queued and one running. A build always
+    compiles the code.txt on disk when it starts, so a burst of submits for a project results in at most
+    one extra build, of the newest source.
+    """
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="latex")
+        self._builds = {}
+        self._condition = threading.Condition()
+
+    def submit(self, project_id, project_dir):
+        """Request a build of the project's current code.txt. Returns the generation to wait for."""
+        with self._condition:
+            build = self._builds.setdefault(project_id, ProjectBuild(project_dir))
+            build.project_dir = project_dir
+            build.requested += 1
+            # A queued build has not read code.txt yet, so it covers this request as well. A running
+            # one may have, in which case _run queues a follow-up build when it finishes.
+            if not build.queued and not build.running:
+                self._enqueue(project_id, build)
+            self._condition.notify_all()
+            return build.requested
+
+    def _enqueue(self, project_id, build):
+        build.queued = True
+        self.executor.submit(self._run, project_id)
+
+    def _run(self, project_id):
+        with self._condition:
+            build = self._builds[project_id]
+            build.queued = False
+            build.running = True
+            generation = build.requested
+            self._condition.notify_all()
+
+        pdf_path = None
+        try:
+            logger.info(f"Compiling LaTeX for project: {project_id}")
+            pdf_path = compile_latex_from_txt(build.project_dir)
+        except Exception as e:
+            logger.error(f"Error compiling LaTeX for project {project_id}: {str(e)}")
+        finally:
+            with self._condition:
+                build.running = False
+                build.built = generation
+                build.pdf_path = pdf_path
+                if build.requested > generation:
+                    self._enqueue(project_id, build)
+                self._condition.notify_all()
+
+    def status(self, project_id):
+        with self._condition:
+            build = self._builds.get(project_id)
+            if build is None:
+                return {"state": "idle", "requested": 0, "built": 0, "succeeded": False}
+            # succeeded: whether the last finished build, of generation built, produced a PDF
+            return {"state": build.state, "requested": build.requested, "built": build.built,
+                    "succeeded": build.pdf_path is not None}
+
+    def wait(self, project_id, generation=None, timeout=None):
+        """
+        Block until the given generation (default: the latest submitted) of the project is built.
+
+        Returns:
+            dict: The project's status, see status(). Its state is still queued or running on timeout.
+        """
+        with self._condition:
+            build = self._builds.get(project_id)
+            if build is not None:
+                target = build.requested if generation is None else generation
+                self._condition.wait_for(lambda: build.built >= target, timeout=timeout)
+        return self.status(project_id)
@@ -0,0 +1,134 @@
+import ast
+import re
+from loguru import logger
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    # Not installed, or the encoding could not be downloaded (offline)
+    _ENCODING = None
+
+# Fixed cost charged per image block. Images are sent as compact copies of at most VISION_MAX_SIDE px,
+# a 1024x1024 image at high detail costs 765 tokens and larger ones are scaled down to about that.
+IMAGE_TOKENS = 765
+# Per message overhead of the chat format (role, separators)
+MESSAGE_TOKENS = 4
+# Stands in for the turns HistoryWindow.fit leaves out
+TRUNCATION_NOTE = {"role": "developer",
+                   "content": "Earlier messages of this conversation were left out to save space. "
+                              "The decisions made in them are reflected in the current tech pack."}
+# Names sent along with a message's images, see build_image_message and the upload routes
+IMAGE_NAMES = re.compile(r"(The names of these (?:\w+ )?images are )(\[.*?\])(\. These come in the same order as the images\.)")
+
+def count_text_tokens(text):
+    """Number of tokens in text, estimated as 4 characters per token when tiktoken is not installed."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def count_message_tokens(message):
+    """Approximate prompt tokens of a chat message, with plain text or a list of text and image blocks as content."""
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return MESSAGE_TOKENS + count_text_tokens(content)
+    tokens = MESSAGE_TOKENS
+    for block in content:
+        if block.get("type") == "image_url":
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += count_text_tokens(block.get("text", ""))
+    return tokens
+
+def keep_image_names(text, kept, count):
+    """
+    Rewrite the image names in text to those of the kept image indices, out of count images.
+    The sentence is dropped if its names do not match the images.
+    """
+    def replace(match):
+        try:
+            names = ast.literal_eval(match.group(2))
+        except (ValueError, SyntaxError):
+            return ""
+        if not isinstance(names, list) or len(names) != count:
+            return ""
+        return match.group(1) + repr([names[i] for i in kept]) + match.group(3)
+    return IMAGE_NAMES.sub(replace, text)
+
+def has_images(message):
+    content = message.get("content")
+    return isinstance(content, list) and any(block.get("type") == "image_url" for block in content)
+
+class HistoryWindow:
+    """
+    Keeps a conversation history under a token budget.
+
+    The leading developer messages (system prompt) and messages holding images are pinned. An image
+    appearing in several messages, e.g. after it was uploaded again, is only kept in the newest one.
+    The remaining turns are kept newest first until the budget is used up, older turns are replaced
+    by TRUNCATION_NOTE.
+    """
+    def __init__(self, max_tokens=12000):
+        self.max_tokens = max_tokens
+
+    def dedupe_images(self, history):
+        """
+        Drop image blocks whose image is sent again later in the history. The list of image names in
+        the message's text is updated to the images that are left.
+        """
+        seen = set()
+        result = []
+        for message in reversed(history):
+            if has_images(message):
+                content = []
+                kept = []
+                count = 0
+                for block in message["content"]:
+                    if block.get("type") == "image_url":
+                        url = block["image_url"]["url"]
+                        count += 1
+                        if url in seen:
+                            continue
+                        seen.add(url)
+                        kept.append(count - 1)
+                    content.append(block)
+                if not kept:
+                    continue
+                if len(kept) < count:
+                    content = [{**block, "text": keep_image_names(block["text"], kept, count)}
+                               if block.get("type") == "text" else block for block in content]
+                message = {**message, "content": content}
+            result.append(message)
+        return result[::-1]
+
+    def fit(self, history):
+        """
+        Return the history trimmed to the token budget, in the original order.
+        The last message is always kept.
+        """
+        truncated = TRUNCATION_NOTE in history
+        history = self.dedupe_images([message for message in history if message != TRUNCATION_NOTE])
+        prefix = 0
+        while prefix < len(history) and history[prefix]["role"] == "developer":
+            prefix += 1
+
+        pinned = {i for i in range(len(history)) if i < prefix or has_images(history[i])}
+        pinned.add(len(history) - 1)
+        used = sum(count_message_tokens(history[i]) for i in pinned)
+
+        kept = set(pinned)
+        for i in range(len(history) - 1, prefix - 1, -1):
+            if i in kept:
+                continue
+            tokens = count_message_tokens(history[i])
+            if used + tokens > self.max_tokens:
+                break
+            kept.add(i)
+            used += tokens
+
+        dropped = len(history) - len(kept)
+        if dropped:
+            logger.info(f"Leaving {dropped} older messages out of the conversation history ({used} tokens kept)")
+        if dropped or truncated:
+            return history[:prefix] + [TRUNCATION_NOTE] + [history[i] for i in range(prefix, len(history)) if i in kept]
+        return history
@@ -0,0 +1,174 @@
+import base64
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from loguru import logger
+from PIL import Image, ImageOps
+
+# Vision models never see more than about 2048px of an image, so larger uploads only cost bandwidth and latency
+VISION_MAX_SIDE = 1536
+VISION_JPEG_QUALITY = 85
+
+def compact_format(path):
+    """
+    Format of the compact copy of an image. PNG uploads are mostly line art and flat colors, which
+    JPEG blurs around the edges while PNG compresses them well, so they stay PNG. Everything else becomes JPEG.
+    """
+    return "PNG" if path.lower().endswith(".png") else "JPEG"
+
+def compact_image_path(path):
+    """Path of the compact copy of an image, e.g. projects/<id>/illustration_compact/front.jpeg.jpg for projects/<id>/illustration/front.jpeg"""
+    folder, name = os.path.split(path)
+    extension = ".png" if compact_format(path) == "PNG" else ".jpg"
+    return os.path.join(folder.rstrip(os.sep) + "_compact", name + extension)
+
+def to_rgb(image):
+    """Flatten transparency onto a white background, as JPEG has no alpha channel."""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+def encode_image(image, format="JPEG", max_side=VISION_MAX_SIDE, quality=VISION_JPEG_QUALITY):
+    """Downscale a PIL image so its longest side is at most max_side and return it as JPEG or PNG bytes."""
+    image = ImageOps.exif_transpose(image)
+    if format == "JPEG":
+        image = to_rgb(image)
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        # Palette images can only be resized with nearest neighbour
+        image = image.convert("RGBA")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = BytesIO()
+    if format == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    else:
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def encode_jpeg(image, max_side=VISION_MAX_SIDE, quality=VISION_JPEG_QUALITY):
+    """Downscale a PIL image so its longest side is at most max_side and return it as JPEG bytes."""
+    return encode_image(image, "JPEG", max_side, quality)
+
+def prepare_image(path, max_side=VISION_MAX_SIDE, quality=VISION_JPEG_QUALITY):
+    """
+    Write a compact copy of the image beside the original (see compact_image_path and compact_format) and return its path.
+    The copy is only rebuilt when the original is newer than it.
+    """
+    compact_path = compact_image_path(path)
+    if os.path.exists(compact_path) and os.path.getmtime(compact_path) >= os.path.getmtime(path):
+        return compact_path
+
+    with Image.open(path) as image:
+        data = encode_image(image, compact_format(path), max_side, quality)
+    os.makedirs(os.path.dirname(compact_path), exist_ok=True)
+    # Write to a temporary file first so concurrent readers never see a partial image
+    tmp_path = f"{compact_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, compact_path)
+    return compact_path
+
+class ImageCache:
+    """
+    Cache of base64 data URLs for images on disk, shared by every place that sends images to the models.
+
+    By default the compact copy made by prepare_image is sent instead of the original upload.
+    Entries are keyed on a hash of the file content, so the same image stored under several
+    paths is only encoded once. A (mtime, size) index per path lets repeated
+    lookups skip reading the file at all until it changes on disk. The total size of the cached
+    data URLs is capped at max_bytes, least recently used entries are evicted first.
+    """
+    def __init__(self, max_bytes=256*1024*1024, max_side=VISION_MAX_SIDE, quality=VISION_JPEG_QUALITY):
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.quality = quality
+        self._digests = {}              # path -> (mtime_ns, size, digest)
+        self._entries = OrderedDict()   # digest -> data url
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_data_url(self, path, compact=True):
+        """
+        Return the image at path as a data URL.
+
+        Args:
+            path (str): Path to the image file.
+            compact (bool, optional): Send the downscaled copy of the image instead of the original file.
+        """
+        if compact:
+            path = prepare_image(path, self.max_side, self.quality)
+        mime_type = mimetypes.guess_type(path)[0] or "image/jpeg"
+
+        stat = os.stat(path)
+        with self._lock:
+            indexed = self._digests.get(path)
+            if indexed is not None and indexed[:2] == (stat.st_mtime_ns, stat.st_size):
+                url = self._entries.get(indexed[2])
+                if url is not None:
+                    self._entries.move_to_end(indexed[2])
+                    self.hits += 1
+                    return url
+
+        with open(path, "rb") as image_file:
+            data = image_file.read()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+        with self._lock:
+            self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+            url = self._entries.get(digest)
+            if url is not None:
+                # Same content already encoded, e.g. under another path
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return url
+            self.misses += 1
+
+        url = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+        self._put(digest, url)
+        return url
+
+    def _put(self, key, url):
+        with self._lock:
+            if key in self._entries:
+                return
+            if len(url) > self.max_bytes:
+                logger.warning(f"Image of {len(url)} bytes exceeds the image cache size, not caching it")
+                return
+            self._entries[key] = url
+            self._size += len(url)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+# Shared by all agents and routes
+image_cache = ImageCache()
+
+if __name__ == "__main__":
+    # Payload size and preparation latency on the demo images: python utils/image_cache.py
+    import glob
+    import time
+    demo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "demo_images")
+    for path in sorted(glob.glob(os.path.join(demo_dir, "*", "*.png"))):
+        start = time.perf_counter()
+        with Image.open(path) as image:
+            data = encode_image(image, compact_format(path))
+        elapsed = time.perf_counter() - start
+        original = os.path.getsize(path)
+        logger.info(f"{os.path.basename(path)}: {original/1024:.0f} KB -> {len(data)/1024:.0f} KB "
+                    f"({len(data)/original:.0%}) in {elapsed*1000:.0f} ms")
@@ -14,4 +14,13 @@ class DrawingCodeTemplate(BaseModel):
     code_blocks: list[str]
 
 class FullTemplate(BaseModel):
-    template_code: str
\ No newline at end of file
+    template_code: str
+
+class SectionEdit(BaseModel):
+    name: str
+    code: str
+
+class SectionEditsTemplate(BaseModel):
+    # True when the request changes code outside the sections, e.g. the colors or the title block
+    full_template: bool
+    sections: list[SectionEdit]
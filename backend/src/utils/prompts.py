@@ -109,9 +109,24 @@ Here is the Latex template you should fill out: \n\
 3. Do not edit FRONT VIEW SECTION and BACK VIEW SECTION, call the generate_drawing_section in your tool box to do that. Do not define this function in Latex.\n\
 4. If you are requested to edit information which do not belong to FRONT VIEW SECTION and BACK VIEW SECTION, do not call generate_drawing_section, and edit the template directly. Think hard about if you need to call this function or not. Some tasks, such as changing the code in the beginning of the template, do not require changing the drawing sections. \n\
 5. Always work with the latest latex code template you have generated. For example, you generate a template, and then the user asks for a modification, then you must modify the template you just generated, and not the original template.\n\
+6. Never remove or rename the %%START_<NAME>%% and %%END_<NAME>%% comment lines, they mark the sections of the template.\n\
 </IMPOARTANT>"
 
 
+# Appended to the code agent conversation to only regenerate the sections that change
+SECTION_EDIT_PROMPT = \
+"Do not respond with the whole template this time. The template is divided into sections, each one starting with a line %%START_<NAME>%% and ending with a line %%END_<NAME>%%.\n\
+<TASK>\n\
+Respond ONLY with the sections that have to change to fulfil the request. For each of them, give its NAME and the complete new latex code that goes between its two marker lines, without the marker lines themselves.\n\
+</TASK>\n\
+<IMPORTANT>\n\
+1. The sections you can edit are: {section_names}. Do not return any other section.\n\
+2. Do not return sections that stay the same. If nothing has been filled out yet, return every section you can edit.\n\
+3. Always start from the latest version of each section.\n\
+4. If the request changes code outside these sections, such as the color definitions, the title block or the commands at the beginning of the template, set full_template to true and return no sections. Otherwise set full_template to false.\n\
+</IMPORTANT>"
+
+
 SYSTEM_PROMPT_DRAWING_AGENT = \
 f"You are an assistant who's job is to analyze images of clothes and use this information to fill out a latex template. You should fill out one template for each image.\n\
 Here is the latex template: \n\
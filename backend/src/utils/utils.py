@@ -4,7 +4,10 @@ from loguru import logger
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import cv2
-import re
+import math
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -12,13 +15,25 @@ def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode("utf-8")
     
-def replace_between_markers(original, start_marker, end_marker, new_content):
-    pattern = re.compile(
-        rf'({re.escape(start_marker)})(.*?){re.escape(end_marker)}',
-        re.DOTALL
-    )
-    return pattern.sub(lambda m: f"{m.group(1)}\n{new_content}\n{end_marker}", original)
-    
+@contextmanager
+def log_duration(stage, timings=None, on_progress=None):
+    """
+    Log how long the enclosed block takes, and record it under timings[stage] if a dict is given.
+    If on_progress is given, it is called with a started and a finished event for the stage.
+    """
+    if on_progress is not None:
+        on_progress({"stage": stage, "status": "started"})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if timings is not None:
+            timings[stage] = elapsed
+        logger.info(f"{stage} took {elapsed:.2f}s")
+        if on_progress is not None:
+            on_progress({"stage": stage, "status": "finished", "seconds": round(elapsed, 3)})
+
 def load_checkpoint(checkpoint_path, model, optimizer=None, scheduler=None):
     """
     Load model checkpoint.
@@ -52,13 +67,55 @@ def load_checkpoint(checkpoint_path, model, optimizer=None, scheduler=None):
     # Return starting epoch and previous train losses
     return checkpoint['epoch'], checkpoint.get('train_losses', [])
 
+@lru_cache(maxsize=256)
+def label_size(label, text_size, thickness=2):
+    """cv2.getTextSize of a keypoint label: ((width, height), baseline)."""
+    return cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, text_size, thickness)
+
+@lru_cache(maxsize=256)
+def keypoint_sprite(label, radius, text_size, dot_color, text_color, left_edge=False):
+    """
+    Pixels of one keypoint marker, a filled dot with its number on it, rendered once with OpenCV.
+
+    left_edge selects the text position used when the label starts left of the image, where
+    truncating the centered x coordinate rounds it up instead of down.
+
+    Returns:
+        tuple: (dy, dx, colors, transparency), the offsets of the drawn pixels from the keypoint,
+            their colors premultiplied by opacity and their transparency, both in [0, 255].
+    """
+    font, thickness = cv2.FONT_HERSHEY_SIMPLEX, 2
+    (text_width, text_height), baseline = label_size(label, text_size, thickness)
+    half = max(radius, text_width, text_height + baseline) + thickness + 2
+    # Text is centered in the dot. Colors are reversed as for OpenCV's BGR, like draw_keypoints always did.
+    text_x = math.ceil(-text_width/2) if left_edge else math.floor(-text_width/2)
+    text_origin = (half + text_x, half + math.floor(text_height/2))
+
+    # Rendering on black and on white recovers the opacity of anti-aliased edges
+    renders = []
+    for background in [0, 255]:
+        canvas = np.full([2*half+1, 2*half+1, 3], background, dtype=np.uint8)
+        cv2.circle(canvas, (half, half), radius, dot_color[::-1], -1)  # -1 fills the circle
+        cv2.putText(canvas, label, text_origin, font, text_size, text_color[::-1], thickness)
+        renders.append(canvas.astype(np.uint16))
+    transparency = (renders[1] - renders[0]).max(axis=-1)
+
+    dy, dx = np.nonzero(transparency < 255)
+    sprite = (dy - half, dx - half, renders[0][dy, dx], transparency[dy, dx, None])
+    for array in sprite:
+        array.flags.writeable = False   # Shared through the cache
+    return sprite
+
 def draw_keypoints(
     image, coordinates, radius=12, text_size=1, 
     dot_color=(0, 255, 0),  # Green in RGB format
     text_color=(0, 0, 255),  # White
-    start_num=1
+    start_num=1, in_place=False, max_side=None
 ):
     """ Draw dots with numbers at specified coordinates on an image.
+
+    Markers are pre-rendered once per label (see keypoint_sprite) and each one is blended
+    onto the image with a single indexed assignment.
     
     Parameters:
     -----------
@@ -76,6 +133,11 @@ def draw_keypoints(
         Color of the text in RGB format (default: white (255, 255, 255))
     start_num : int, optional
         Starting number for the dots (default: 1)
+    in_place : bool, optional
+        Draw into image instead of a copy, when it is already a uint8 RGB(A) array (default: False)
+    max_side : int, optional
+        Downscale the image so its longest side is at most max_side before drawing, the coordinates
+        are given at the original resolution (default: None, full resolution)
         
     Returns:
     --------
@@ -86,46 +148,42 @@ def draw_keypoints(
     if image.dtype != np.uint8:
         image = image.astype(np.uint8)
 
+    if image.ndim == 2:
+        image = np.stack([image, image, image], axis=-1)
+
     if image.shape[-1] == 4:
         image = image[:,:,:3]
 
-    result_image = image.copy()
-    
-    # Get image dimensions
-    height, width = result_image.shape[:2]
-    
-    # Draw dots and numbers at each coordinate
-    for i, (x, y) in enumerate(coordinates):
-        # Convert coordinates to integers if they aren't already
-        x, y = int(x), int(y)
-        
-        # Ensure coordinates are within image bounds
-        if x < 0 or x >= width or y < 0 or y >= height:
-            continue
-        
-        # Convert RGB to BGR for OpenCV functions
-        bgr_dot_color = dot_color[::-1]  # Reverse the RGB tuple to get BGR
-        bgr_text_color = text_color[::-1]  # Reverse the RGB tuple to get BGR
-        
-        # Draw the dot
-        cv2.circle(result_image, (x, y), radius, bgr_dot_color, -1)  # -1 fills the circle
-        
-        # Calculate text to be drawn
-        text = str(i + start_num)
-        text_font = cv2.FONT_HERSHEY_SIMPLEX
-        text_thickness = 2
-        
-        # Get text size to center it properly
-        (text_width, text_height), baseline = cv2.getTextSize(text, text_font, text_size, text_thickness)
-        
-        # Calculate position to center text in the dot
-        text_x = int(x - text_width / 2)
-        text_y = int(y + text_height / 2)
-        
-        # Draw the number
-        cv2.putText(result_image, text, (text_x, text_y), text_font, text_size, bgr_text_color, text_thickness)
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    height, width = image.shape[:2]
+    if max_side is not None and max(height, width) > max_side:
+        scale = max_side / max(height, width)
+        height, width = max(1, round(height*scale)), max(1, round(width*scale))
+        image = cv2.resize(np.ascontiguousarray(image), (width, height), interpolation=cv2.INTER_AREA)
+        coordinates = coordinates*scale
+    elif not in_place:
+        image = image.copy()
+
+    # Convert coordinates to integers and skip the ones outside the image
+    xs, ys = coordinates[:,0].astype(np.int64), coordinates[:,1].astype(np.int64)
+    indices = np.flatnonzero((xs >= 0) & (xs < width) & (ys >= 0) & (ys < height))
+    if indices.size == 0:
+        return image
+
+    for i in indices:
+        label = str(i + start_num)
+        dy, dx, colors, transparency = keypoint_sprite(
+            label, radius, text_size, tuple(dot_color), tuple(text_color),
+            left_edge=bool(xs[i] < label_size(label, text_size)[0][0]/2)
+        )
+        py, px = dy + ys[i], dx + xs[i]
+        inside = (py >= 0) & (py < height) & (px >= 0) & (px < width)
+        py, px = py[inside], px[inside]
+        # Blend the marker over what is underneath, which may be an earlier marker
+        background = image[py, px].astype(np.uint16)
+        image[py, px] = np.minimum(colors[inside] + (transparency[inside]*background + 127)//255, 255)
     
-    return result_image
+    return image
 
 def normalize_image(image: Image.Image):
     """
@@ -153,4 +211,15 @@ def normalize_image(image: Image.Image):
     # Normalize (broadcasting across channels)
     normalized_image = (image_array - mean) / std
 
-    return normalized_image
\ No newline at end of file
+    return normalized_image
+
+if __name__ == "__main__":
+    # draw_keypoints on a 4K image: python -m utils.utils
+    import timeit
+    image = np.random.default_rng(0).integers(0, 256, size=(2160, 3840, 3), dtype=np.uint8)
+    coordinates = np.random.default_rng(1).uniform(0, 2160, size=(6, 2))
+    for label, draw in [("copy", lambda: draw_keypoints(image, coordinates)),
+                        ("in place", lambda: draw_keypoints(image, coordinates, in_place=True)),
+                        ("1536 preview", lambda: draw_keypoints(image, coordinates, max_side=1536))]:
+        seconds = min(timeit.repeat(draw, number=20, repeat=3)) / 20
+        logger.info(f"{label}: {seconds*1000:.2f} ms")
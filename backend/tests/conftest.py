@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The backend runs from backend/src, with its modules imported top-level
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
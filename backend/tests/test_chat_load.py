@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from collections import Counter
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("cv2")
+pytest.importorskip("transformers")
+fastapi = pytest.importorskip("fastapi")
+uvicorn = pytest.importorskip("uvicorn")
+httpx = pytest.importorskip("httpx")
+openai = pytest.importorskip("openai")
+from fastapi.responses import StreamingResponse
+from loguru import logger
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+class FakeOpenAI:
+    """
+    Local stand-in for the OpenAI chat completions API. Every completion streams chunks tokens after
+    first_token_delay seconds, one every chunk_delay seconds. The number of completions in flight is
+    tracked per conversation, keyed on the first word of the last user message.
+    """
+    def __init__(self, first_token_delay=0.3, chunks=20, chunk_delay=0.01):
+        self.first_token_delay = first_token_delay
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.in_flight = Counter()
+        self.max_in_flight = Counter()
+        self.total_in_flight = 0
+        self.max_total_in_flight = 0
+        self.app = fastapi.FastAPI()
+        self.app.post("/v1/chat/completions")(self.completions)
+
+    @property
+    def latency(self):
+        return self.first_token_delay + self.chunks * self.chunk_delay
+
+    async def completions(self, request: fastapi.Request):
+        body = await request.json()
+        key = [message for message in body["messages"] if message["role"] == "user"][-1]["content"].split()[0]
+
+        def chunk(delta, finish_reason=None):
+            data = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def stream():
+            self.in_flight[key] += 1
+            self.max_in_flight[key] = max(self.max_in_flight[key], self.in_flight[key])
+            self.total_in_flight += 1
+            self.max_total_in_flight = max(self.max_total_in_flight, self.total_in_flight)
+            try:
+                await asyncio.sleep(self.first_token_delay)
+                yield chunk({"role": "assistant", "content": ""})
+                for i in range(self.chunks):
+                    yield chunk({"content": f"token{i} "})
+                    await asyncio.sleep(self.chunk_delay)
+                yield chunk({}, "stop")
+                yield "data: [DONE]\n\n"
+            finally:
+                self.in_flight[key] -= 1
+                self.total_in_flight -= 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+class Server:
+    """Runs an ASGI app with uvicorn on a free local port, in a background thread."""
+    def __init__(self, app):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.should_exit = True
+        self.thread.join()
+
+def backend_app(openai_url):
+    """The /chat route of the backend, with SQLite storage and an OpenAI client pointed at openai_url."""
+    from routes import ChatRoutes
+    from sessions import SessionManager
+    from database import DatabaseManager
+    client = openai.OpenAI(base_url=f"{openai_url}/v1", api_key="fake", max_retries=0)
+    database = DatabaseManager()
+    app = fastapi.FastAPI()
+    app.include_router(ChatRoutes(SessionManager(client, database), database).router)
+    return app, database
+
+async def chat(client, url, project_id, message):
+    """Send one chat message and read its stream. Returns the reply, the time to its first content and the total time."""
+    start = time.perf_counter()
+    first_content = None
+    reply = ""
+    done = False
+    async with client.stream("POST", f"{url}/chat", json={"content": message, "projectId": project_id, "userId": "load"}) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[len("data: "):])
+            assert "error" not in event, event["error"]
+            if "content" in event:
+                first_content = first_content or time.perf_counter() - start
+                reply += event["content"]
+            done = done or event.get("done", False)
+    assert done
+    return reply, first_content, time.perf_counter() - start
+
+async def run_chats(url, project_ids):
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=len(project_ids))) as client:
+        return await asyncio.gather(*[chat(client, url, project_id, f"{project_id} Hello, I need a tech pack")
+                                      for project_id in project_ids])
+
+def run_load(project_ids, fake):
+    """Run one chat per entry of project_ids at once against the backend. Returns the results of chat() and the wall time."""
+    with Server(fake.app) as openai_server:
+        app, database = backend_app(openai_server.url)
+        try:
+            with Server(app) as backend:
+                start = time.perf_counter()
+                results = asyncio.run(run_chats(backend.url, project_ids))
+                return results, time.perf_counter() - start
+        finally:
+            database.close()
+
+@pytest.fixture
+def offline_backend(monkeypatch, tmp_path):
+    # The prompts are read from ./templates relative to backend/src, the projects are written to the working directory
+    monkeypatch.chdir(SRC_DIR)
+    import models  # noqa: F401
+    from database import DatabaseManager
+    monkeypatch.setenv("TECHPACK_STORAGE", "sqlite")
+    monkeypatch.setenv("TECHPACK_SQLITE_PATH", str(tmp_path / "techpack.db"))
+    monkeypatch.setattr(DatabaseManager, "_instance", None)
+    monkeypatch.chdir(tmp_path)
+
+def test_concurrent_chat_streams_overlap(offline_backend):
+    fake = FakeOpenAI()
+    sessions = 50
+    results, seconds = run_load([f"project-{i}" for i in range(sessions)], fake)
+
+    expected = "".join(f"token{i} " for i in range(fake.chunks))
+    assert [reply for reply, _, _ in results] == [expected] * sessions
+    assert fake.max_total_in_flight > sessions // 2
+    # Serialized streams would take sessions * fake.latency
+    assert seconds < sessions * fake.latency / 5
+
+def test_chats_of_one_project_take_turns(offline_backend):
+    fake = FakeOpenAI(first_token_delay=0.1, chunks=5)
+    results, _ = run_load(["project"] * 4, fake)
+
+    assert len(results) == 4
+    assert fake.max_in_flight["project"] == 1
+
+if __name__ == "__main__":
+    # Throughput of /chat with 50 concurrent sessions against a local fake OpenAI server: python tests/test_chat_load.py
+    import sys
+    import tempfile
+    sys.path.insert(0, SRC_DIR)
+    os.chdir(SRC_DIR)
+    import models  # noqa: F401
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["TECHPACK_STORAGE"] = "sqlite"
+        os.environ["TECHPACK_SQLITE_PATH"] = os.path.join(tmp, "techpack.db")
+        os.chdir(tmp)
+        fake = FakeOpenAI()
+        sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+        results, seconds = run_load([f"project-{i}" for i in range(sessions)], fake)
+        first_content = [first for _, first, _ in results]
+        totals = [total for _, _, total in results]
+        logger.info(f"{sessions} concurrent sessions in {seconds:.2f}s: {sessions/seconds:.1f} streams/s, "
+                    f"{sessions*fake.chunks/seconds:.0f} chunks/s (fake completion takes {fake.latency:.2f}s, "
+                    f"{sessions*fake.latency:.1f}s if serialized)")
+        logger.info(f"First content p50 {statistics.median(first_content)*1000:.0f} ms, max {max(first_content)*1000:.0f} ms; "
+                    f"stream p50 {statistics.median(totals)*1000:.0f} ms, max {max(totals)*1000:.0f} ms; "
+                    f"{fake.max_total_in_flight} completions in flight at most")
@@ -0,0 +1,110 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from database import WriteBehindBuffer, ProjectMessages, parse_timestamp
+from storage import Storage
+
+class MemoryStorage(Storage):
+    """Stand-in for Supabase that records every insert request, optionally failing the first ones."""
+    def __init__(self, failures=0):
+        self.requests = []
+        self.failures = failures
+        self.lock = threading.Lock()
+
+    def insert(self, table, rows):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("unavailable")
+            self.requests.append((table, list(rows)))
+        return rows
+
+    def fetch(self, table, project_id, user_id, columns, since=None):
+        return [row for t, rows in self.requests for row in rows if t == table and row['project_id'] == project_id]
+
+    def test_connection(self):
+        pass
+
+def message(project_id, i):
+    return {'content': str(i), 'type': 'user', 'project_id': project_id, 'user_id': 'user'}
+
+def test_rows_are_batched_in_order():
+    storage = MemoryStorage()
+    writer = WriteBehindBuffer(storage, max_batch=10, max_delay=0.05)
+    for i in range(25):
+        writer.put('messages', message('a' if i % 2 else 'b', i))
+    writer.close()
+
+    assert [len(rows) for _, rows in storage.requests] == [10, 10, 5]
+    for project_id in ['a', 'b']:
+        contents = [int(row['content']) for row in storage.fetch('messages', project_id, 'user', [])]
+        assert contents == sorted(contents)
+
+def test_tables_are_split_without_reordering():
+    storage = MemoryStorage()
+    writer = WriteBehindBuffer(storage, max_batch=10, max_delay=0.05)
+    for table in ['messages', 'messages', 'prompts', 'messages']:
+        writer.put(table, message('a', 0))
+    writer.close()
+
+    assert [(table, len(rows)) for table, rows in storage.requests] == [('messages', 2), ('prompts', 1), ('messages', 1)]
+
+def test_flush_does_not_wait_for_max_delay():
+    storage = MemoryStorage()
+    writer = WriteBehindBuffer(storage, max_delay=5)
+    ticket = writer.put('messages', message('a', 0))
+    start = time.perf_counter()
+    assert writer.flush(ticket, timeout=2)
+    assert time.perf_counter() - start < 1
+    assert len(storage.requests) == 1
+    writer.close()
+
+def test_failed_inserts_are_retried_in_order():
+    storage = MemoryStorage(failures=2)
+    writer = WriteBehindBuffer(storage, max_delay=0.01, retry_delay=0.01)
+    writer.put('messages', message('a', 0))
+    writer.flush(timeout=2)
+    writer.put('messages', message('a', 1))
+    writer.close()
+
+    assert [row['content'] for row in storage.fetch('messages', 'a', 'user', [])] == ['0', '1']
+
+def test_project_messages_with_uuid_ids():
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    rows = [{'id': str(uuid.uuid4()), 'type': 'user', 'content': f"m{i}",
+             'created_at': (start + timedelta(seconds=i)).isoformat()} for i in range(10)]
+
+    def fetch(since):
+        # What the storage returns for the cursor, in (created_at, id) order
+        return sorted((row for row in rows if since is None or row['created_at'] >= since),
+                      key=lambda row: (row['created_at'], row['id']))
+
+    cached = ProjectMessages()
+    rows, later = rows[:5], rows[5:]
+    cached.merge(fetch(cached.since))
+    rows += later
+    cached.merge(fetch(cached.since))
+
+    assert [message['content'] for message in cached.messages] == [f"m{i}" for i in range(10)]
+
+def test_late_rows_with_earlier_timestamps_are_merged():
+    def row(created_at):
+        return {'id': str(uuid.uuid4()), 'type': 'user', 'content': created_at, 'created_at': created_at}
+
+    cached = ProjectMessages()
+    first, second = row("2025-01-01T00:00:01+00:00"), row("2025-01-01T00:00:03+00:00")
+    cached.merge([first, second])
+    # Written by another server after the second row, with an earlier timestamp inside the overlap window
+    late = row("2025-01-01T00:00:02+00:00")
+    assert late['created_at'] >= cached.since
+    cached.merge([first, late, second])
+
+    assert [message['content'] for message in cached.messages] == [first['content'], late['content'], second['content']]
+
+def test_parse_timestamp_formats():
+    expected = datetime(2025, 1, 1, 12, 0, 0, 123450, tzinfo=timezone.utc)
+    # PostgREST trims trailing zeros, SQLite stores isoformat()
+    assert parse_timestamp("2025-01-01T12:00:00.12345+00:00") == expected
+    assert parse_timestamp(expected.isoformat()) == expected
+    assert parse_timestamp("2025-01-01T12:00:00Z") == expected.replace(microsecond=0)
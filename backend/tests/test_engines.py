@@ -0,0 +1,34 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+from detector.FashionDetector import ViTFashionDetector
+from detector.engines import BACKENDS, INPUT_SIZE, EagerEngine, create_engine
+from utils.keypoints import extract_keypoints_from_heatmaps
+
+@pytest.fixture(scope="module")
+def detector():
+    # A small detector with random weights, no checkpoint or download needed
+    torch.manual_seed(0)
+    backbone = transformers.VitPoseBackboneConfig(hidden_size=64, num_hidden_layers=2, num_attention_heads=4,
+                                                  out_indices=[2])
+    config = transformers.VitPoseConfig(backbone_config=backbone)
+    return ViTFashionDetector(num_labels=6, pretrained=False, config=config).eval()
+
+@pytest.mark.parametrize("backend", [backend for backend in BACKENDS if backend not in ["eager", "int8"]])
+def test_heatmaps_match_eager(detector, backend, tmp_path):
+    if backend == "onnx":
+        pytest.importorskip("onnxruntime")
+    x = torch.randn(4, 3, *INPUT_SIZE)
+    reference = EagerEngine(detector, torch.device("cpu"))(x)
+
+    heatmaps = create_engine(detector, backend, export_dir=str(tmp_path))(x)
+
+    assert heatmaps.shape == reference.shape
+    torch.testing.assert_close(heatmaps, reference, rtol=1e-3, atol=1e-3)
+    assert torch.equal(extract_keypoints_from_heatmaps(heatmaps), extract_keypoints_from_heatmaps(reference))
+
+def test_int8_heatmaps_have_the_eager_shape(detector):
+    # int8 is approximate by design, see finetune/eval_quantization.py for its accuracy
+    x = torch.randn(2, 3, *INPUT_SIZE)
+    assert create_engine(detector, "int8")(x).shape == EagerEngine(detector, torch.device("cpu"))(x).shape
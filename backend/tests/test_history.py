@@ -0,0 +1,21 @@
+from utils.history import HistoryWindow
+
+def image(url):
+    return {"type": "image_url", "image_url": {"url": url}}
+
+def upload(names, urls):
+    text = (f"Here are the reference image(s).\nThe names of these reference images are {names}. "
+            "These come in the same order as the images.\n")
+    return {"role": "user", "content": [{"type": "text", "text": text}] + [image(url) for url in urls]}
+
+def test_dedupe_images_keeps_the_names_of_the_images_left():
+    history = [upload(['front.png', 'back.png'], ["front", "back"]), upload(['front.png'], ["front"])]
+    first, second = HistoryWindow().dedupe_images(history)
+
+    assert [block["image_url"]["url"] for block in first["content"][1:]] == ["back"]
+    assert "are ['back.png']. These come" in first["content"][0]["text"]
+    assert second == history[1]
+
+def test_dedupe_images_drops_messages_without_images_left():
+    history = [upload(['front.png'], ["front"]), upload(['front.png'], ["front"])]
+    assert HistoryWindow().dedupe_images(history) == history[1:]
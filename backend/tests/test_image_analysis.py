@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("cv2")
+pytest.importorskip("transformers")
+Image = pytest.importorskip("PIL.Image")
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+class SlowParseClient:
+    """
+    Stand-in for the OpenAI client: keypoint selection requests keep keypoints 1 and 3, and each one
+    is faster than the previous, so the responses come back in the opposite order of the requests.
+    """
+    def __init__(self, latencies=()):
+        self.latencies = list(latencies)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(parse=self.parse)))
+
+    def parse(self, model, messages, response_format):
+        with self.lock:
+            latency = self.latencies[self.calls] if self.calls < len(self.latencies) else 0
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        parsed = response_format(filtered_kpts=[1, 3])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))])
+
+@pytest.fixture
+def models(monkeypatch):
+    # The prompts are read from ./templates, relative to backend/src
+    monkeypatch.chdir(SRC_DIR)
+    import models
+    return models
+
+def test_filter_keypoints_keeps_order_and_bounds_concurrency(models, tmp_path):
+    names = [f"image_{i}.png" for i in range(8)]
+    client = SlowParseClient(latencies=[0.05 * (len(names) - i) for i in range(len(names))])
+    agent = models.ImageAnalysisAgent(client, max_concurrency=3)
+    for name in names:
+        Image.fromarray(np.full((128, 96, 3), 255, dtype=np.uint8)).save(tmp_path / name)
+    images = [Image.open(tmp_path / name).convert("RGB") for name in names]
+    kpts = [np.arange(12, dtype=np.float32).reshape(6, 2) + 10*i for i in range(len(names))]
+
+    filtered = agent.filter_keypoints(images, str(tmp_path), names, kpts)
+
+    assert client.calls == len(names)
+    assert client.max_in_flight == 3
+    for i, kept in enumerate(filtered):
+        np.testing.assert_array_equal(kept, kpts[i][[0, 2]])
+
+def test_filter_keypoints_without_images(models):
+    agent = models.ImageAnalysisAgent(SlowParseClient(), max_concurrency=3)
+    assert agent.filter_keypoints([], "", [], []) == []
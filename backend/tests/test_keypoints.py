@@ -0,0 +1,61 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+from utils.keypoints import augment_upper_body_kpts, kp2ind
+
+def reflect_point_across_line(P, A, B):
+    """Reference implementation, as before augment_upper_body_kpts was vectorized."""
+    x0, y0 = P
+    x1, y1 = A
+    x2, y2 = B
+    a = y2 - y1
+    b = x1 - x2
+    c = x2 * y1 - x1 * y2
+    d = (a * x0 + b * y0 + c) / (a**2 + b**2)
+    return np.array([x0 - 2 * a * d, y0 - 2 * b * d])
+
+def augment_upper_body_kpts_reference(kpts):
+    """Reference implementation, one keypoint set at a time."""
+    ind = kp2ind['upper_body']
+    left_collar, right_collar = kpts[ind['left_collar']], kpts[ind['right_collar']]
+    left_hem, right_hem = kpts[ind['left_hem']], kpts[ind['right_hem']]
+    center = torch.mean(torch.stack([left_collar, right_collar, left_hem, right_hem]).float(), dim=0)
+    center_up = torch.mean(torch.stack([left_collar, right_collar, center]).float(), dim=0)
+    center_down = torch.mean(torch.stack([left_hem, right_hem, center]).float(), dim=0)
+    left_breast = torch.from_numpy(reflect_point_across_line(right_collar, left_collar, center_up))
+    right_breast = torch.from_numpy(reflect_point_across_line(left_collar, right_collar, center_up))
+    left_pocket = torch.from_numpy(reflect_point_across_line(center_down, center, left_hem))
+    right_pocket = torch.from_numpy(reflect_point_across_line(center_down, center, right_hem))
+    left_shoulder = torch.from_numpy(reflect_point_across_line(center_up, left_breast, left_collar))
+    right_shoulder = torch.from_numpy(reflect_point_across_line(center_up, right_breast, right_collar))
+    return torch.vstack([kpts, center, center_up, center_down, left_breast, right_breast,
+                         left_pocket, right_pocket, left_shoulder, right_shoulder])
+
+def random_upper_body_kpts(generator, *batch):
+    # Collars near the top of the 192x256 input, hems near the bottom, so no line is degenerate
+    kpts = torch.rand(*batch, 6, 2, generator=generator) * torch.tensor([192.0, 64.0])
+    kpts[..., 4:, 1] += 192
+    return kpts
+
+def test_matches_reference_on_single_sets():
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(50):
+        kpts = random_upper_body_kpts(generator)
+        expected = augment_upper_body_kpts_reference(kpts).float()
+        actual = augment_upper_body_kpts(kpts)
+        assert actual.shape == (15, 2)
+        torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-4)
+
+def test_batch_matches_single_sets():
+    generator = torch.Generator().manual_seed(1)
+    kpts = random_upper_body_kpts(generator, 16)
+    actual = augment_upper_body_kpts(kpts)
+    assert actual.shape == (16, 15, 2)
+    for i in range(len(kpts)):
+        torch.testing.assert_close(actual[i], augment_upper_body_kpts_reference(kpts[i]).float(), rtol=1e-5, atol=1e-4)
+
+def test_integer_keypoints():
+    kpts = torch.tensor([[60, 20], [130, 22], [10, 120], [180, 118], [55, 240], [140, 238]])
+    torch.testing.assert_close(augment_upper_body_kpts(kpts), augment_upper_body_kpts_reference(kpts).float(),
+                               rtol=1e-5, atol=1e-4)
@@ -0,0 +1,26 @@
+import sqlite3
+import pytest
+from storage import Storage, SQLiteStorage
+
+def message(i):
+    return {'content': str(i), 'type': 'user', 'project_id': 'a', 'user_id': 'user'}
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+def test_sqlite_insert_returns_the_stored_ids(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "test.db"), pool_size=2)
+    storage.insert('messages', [message(i) for i in range(3)])
+    # AUTOINCREMENT does not reuse the ids of deleted rows, so MAX(id)+1 would be wrong here
+    connection = sqlite3.connect(str(tmp_path / "test.db"))
+    connection.execute("DELETE FROM messages WHERE id = 3")
+    connection.commit()
+    connection.close()
+
+    inserted = storage.insert('messages', [message(i) for i in range(3, 5)])
+    stored = storage.fetch('messages', 'a', 'user', ['id', 'content'])
+    storage.close()
+
+    assert [row['id'] for row in inserted] == [4, 5]
+    assert {row['content']: row['id'] for row in stored} == {'0': 1, '1': 2, '3': 4, '4': 5}
@@ -0,0 +1,89 @@
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Subset
+from models.models import ViTFashionDetector
+from Deepfashion_Dataset import Deepfashion_Dataset
+from utils.utils import load_checkpoint
+from utils.keypoints import extract_keypoints_from_heatmaps
+from loguru import logger
+from io import BytesIO
+from tqdm import tqdm
+import argparse
+import time
+import os
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Accuracy of the dynamically quantized int8 detector against fp32.")
+    parser.add_argument("--data_dir", type=str, default="../deepfashion/", help="Directory where your data files are located")
+    parser.add_argument("--checkpoint", type=str, default="../backend/src/detector/checkpoint_epoch_30.pth", help="fp32 checkpoint to quantize")
+    parser.add_argument("--split", type=str, default="test", help="Partition of list_eval_partition.txt to evaluate on")
+    parser.add_argument("--holdout", type=float, default=0.1, help="Fraction of images (taken from the end) used when there is no partition file")
+    parser.add_argument("--max_images", type=int, default=2000, help="Max number of held-out images to evaluate")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size for inference")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of workers.")
+
+    return parser.parse_args()
+
+def heldout_indices(dataset, data_dir, split, holdout):
+    """Indices of the held-out images, from DeepFashion's list_eval_partition.txt when present."""
+    for partition_path in [os.path.join(data_dir, "list_eval_partition.txt"), os.path.join(data_dir, "Eval", "list_eval_partition.txt")]:
+        if os.path.exists(partition_path):
+            with open(partition_path, 'r') as file:
+                partitions = dict(line.split()[:2] for line in file.readlines()[2:])
+            logger.info(f"Using the {split} partition of {partition_path}")
+            return [i for i, name in enumerate(dataset.images) if partitions.get(name) == split]
+
+    n_heldout = int(len(dataset) * holdout)
+    logger.warning(f"No partition file found, using the last {n_heldout} images")
+    return list(range(len(dataset) - n_heldout, len(dataset)))
+
+def model_size(model):
+    """Size of the serialized state dict in MB."""
+    buffer = BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1e6
+
+def main():
+    args = get_args()
+    torch.set_num_threads(os.cpu_count())
+
+    dataset = Deepfashion_Dataset(args.data_dir, img_size=(256, 192), scale_factor=4, clothing_type="upper_body")
+    indices = heldout_indices(dataset, args.data_dir, args.split, args.holdout)[:args.max_images]
+    dataloader = DataLoader(Subset(dataset, indices), args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    fp32_model = ViTFashionDetector(num_labels=6)
+    load_checkpoint(args.checkpoint, fp32_model)
+    fp32_model.eval()
+    int8_model = torch.ao.quantization.quantize_dynamic(fp32_model, {nn.Linear}, dtype=torch.qint8)
+
+    distances = []          # int8 vs fp32 keypoints
+    errors = {"fp32": [], "int8": []}    # Predictions vs ground truth
+    seconds = {"fp32": 0.0, "int8": 0.0}
+    with torch.inference_mode():
+        for names, images, kpts, score_maps in tqdm(dataloader, desc="Evaluating"):
+            preds = {}
+            for label, model in [("fp32", fp32_model), ("int8", int8_model)]:
+                start = time.perf_counter()
+                heatmaps = model(images)['heatmaps']
+                seconds[label] += time.perf_counter() - start
+                # Heatmaps are 4x smaller than the 256x192 input
+                preds[label] = extract_keypoints_from_heatmaps(heatmaps) * 4
+
+            # Keypoints that are not present in the image have empty score maps
+            visible = score_maps.flatten(2).amax(dim=-1) > 0
+            distances.append((preds["int8"] - preds["fp32"]).norm(dim=-1)[visible])
+            for label in errors:
+                errors[label].append((preds[label] - kpts.float()).norm(dim=-1)[visible])
+
+    distances = torch.cat(distances)
+    logger.info(f"Evaluated {len(indices)} held-out images, {len(distances)} visible keypoints (pixels at 256x192)")
+    logger.info(f"int8 vs fp32: mean keypoint distance {distances.mean():.3f}, median {distances.median():.3f}, "
+                f"max {distances.max():.3f}, identical {(distances == 0).float().mean():.1%}")
+    for label in errors:
+        error = torch.cat(errors[label])
+        logger.info(f"{label}: mean error vs ground truth {error.mean():.3f}, PCK@5px {(error < 5).float().mean():.1%}, "
+                    f"{model_size(fp32_model if label == 'fp32' else int8_model):.0f} MB, "
+                    f"{seconds[label]/len(indices)*1000:.1f} ms/image")
+
+if __name__ == "__main__":
+    main()
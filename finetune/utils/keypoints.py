@@ -1,4 +1,6 @@
+import math
 import torch
+import torch.nn.functional as F
 import numpy as np
 
 kp2ind_full_body = {
@@ -44,17 +46,99 @@ def extract_keypoints_from_heatmap(heatmap):
     Returns:
         keypoints: List of (x, y) keypoints
     """
-    N_k, H, W = heatmap.shape
-    keypoints = []
+    keypoints = extract_keypoints_from_heatmaps(heatmap.unsqueeze(0))[0]
 
-    for i in range(N_k):
-        # Get index of max value in heatmap
-        idx = torch.argmax(heatmap[i])
-        y, x = divmod(idx.item(), W)  # Convert to (y, x) coordinates
-        keypoints.append((x, y))
+    return [tuple(kp) for kp in keypoints.long().tolist()]
+
+def extract_keypoints_from_heatmaps(heatmaps, refine=None, sigma=2):
+    """
+    Extracts keypoint coordinates from a batch of predicted heatmaps without any
+    per-keypoint Python loop or host synchronization.
+
+    Args:
+        heatmaps: Tensor of shape (B, N_k, H, W)
+        refine: Sub-pixel refinement mode. None keeps the integer argmax, "quarter" shifts
+            each keypoint a quarter pixel towards its higher neighbour, and "dark" applies
+            the Taylor expansion of the log heatmap (DARK).
+        sigma: Standard deviation of the training Gaussians, used to smooth heatmaps for "dark".
+
+    Returns:
+        keypoints: Tensor of shape (B, N_k, 2) with (x, y) keypoints
+    """
+    assert refine in [None, "quarter", "dark"], "refine must be None, quarter or dark"
+    B, N_k, H, W = heatmaps.shape
+    idx = torch.argmax(heatmaps.reshape(B, N_k, -1), dim=-1)
+    x, y = idx % W, torch.div(idx, W, rounding_mode='floor')
+    keypoints = torch.stack([x, y], dim=-1).float()
+
+    if refine == "quarter":
+        dx = sample_heatmaps(heatmaps, x+1, y) - sample_heatmaps(heatmaps, x-1, y)
+        dy = sample_heatmaps(heatmaps, x, y+1) - sample_heatmaps(heatmaps, x, y-1)
+        dx = torch.where((x > 0) & (x < W-1), torch.sign(dx), torch.zeros_like(dx))
+        dy = torch.where((y > 0) & (y < H-1), torch.sign(dy), torch.zeros_like(dy))
+        keypoints = keypoints + 0.25*torch.stack([dx, dy], dim=-1)
+    elif refine == "dark":
+        keypoints = keypoints + dark_offsets(heatmaps, x, y, sigma)
 
     return keypoints
 
+def sample_heatmaps(heatmaps, x, y):
+    """
+    Gathers heatmap values at integer locations, clamping to the heatmap borders.
+
+    Args:
+        heatmaps: Tensor of shape (B, N_k, H, W)
+        x, y: Long tensors of shape (B, N_k)
+
+    Returns:
+        values: Tensor of shape (B, N_k)
+    """
+    B, N_k, H, W = heatmaps.shape
+    idx = y.clamp(0, H-1)*W + x.clamp(0, W-1)
+
+    return heatmaps.reshape(B, N_k, -1).gather(-1, idx.unsqueeze(-1)).squeeze(-1)
+
+def dark_offsets(heatmaps, x, y, sigma=2):
+    """
+    Computes DARK sub-pixel offsets (Zhang et al., 2020) around the argmax locations.
+    The heatmaps are smoothed with a Gaussian, moved to log space and the offset is
+    given by -H^-1 * g, where g and H are the gradient and Hessian at the argmax.
+
+    Returns:
+        offsets: Tensor of shape (B, N_k, 2)
+    """
+    B, N_k, H, W = heatmaps.shape
+    radius = int(math.ceil(3*sigma))
+    kernel = torch.exp(-0.5*(torch.arange(-radius, radius+1, device=heatmaps.device)/sigma)**2)
+    kernel = (kernel/kernel.sum()).to(heatmaps.dtype)
+
+    hm = heatmaps.reshape(B*N_k, 1, H, W)
+    blurred = F.conv2d(hm, kernel.view(1, 1, 1, -1), padding=(0, radius))
+    blurred = F.conv2d(blurred, kernel.view(1, 1, -1, 1), padding=(radius, 0))
+    # Keep the original peak height, as in the reference implementation
+    hm_max = hm.amax(dim=(2, 3), keepdim=True)
+    blurred_max = blurred.amax(dim=(2, 3), keepdim=True).clamp(min=1e-10)
+    log_hm = torch.log((blurred*hm_max/blurred_max).clamp(min=1e-10)).reshape(B, N_k, H, W)
+
+    def at(ox, oy):
+        return sample_heatmaps(log_hm, x+ox, y+oy)
+
+    center = at(0, 0)
+    dx = 0.5*(at(1, 0) - at(-1, 0))
+    dy = 0.5*(at(0, 1) - at(0, -1))
+    dxx = 0.25*(at(2, 0) - 2*center + at(-2, 0))
+    dyy = 0.25*(at(0, 2) - 2*center + at(0, -2))
+    dxy = 0.25*(at(1, 1) - at(1, -1) - at(-1, 1) + at(-1, -1))
+
+    det = dxx*dyy - dxy**2
+    valid = (x > 1) & (x < W-2) & (y > 1) & (y < H-2) & (det != 0)
+    det = torch.where(valid, det, torch.ones_like(det))
+    offset_x = -(dyy*dx - dxy*dy)/det
+    offset_y = -(dxx*dy - dxy*dx)/det
+    offsets = torch.stack([offset_x, offset_y], dim=-1)
+
+    return torch.where(valid.unsqueeze(-1), offsets, torch.zeros_like(offsets))
+
 def get_gaussian_scoremap(
     shape, 
     keypoint: np.ndarray, 
@@ -93,63 +177,61 @@ def reflect_point_across_line(P, A, B):
     
     return np.array([x_reflected, y_reflected])
 
-def augment_upper_body_kpts(kpts): 
-        center = torch.mean(torch.stack([
-            kpts[kp2ind['upper_body']['left_collar']],
-            kpts[kp2ind['upper_body']['right_collar']],
-            kpts[kp2ind['upper_body']['left_hem']],
-            kpts[kp2ind['upper_body']['right_hem']]
-        ]).float(),dim=0)
-
-        center_up = torch.mean(torch.stack([
-            kpts[kp2ind['upper_body']['left_collar']],
-            kpts[kp2ind['upper_body']['right_collar']],
-            center
-        ]).float(),dim=0)
-        
-        center_down = torch.mean(torch.stack([
-            kpts[kp2ind['upper_body']['left_hem']],
-            kpts[kp2ind['upper_body']['right_hem']],
-            center
-        ]).float(),dim=0)
-
-        left_breast = torch.from_numpy(reflect_point_across_line(
-            kpts[kp2ind['upper_body']['right_collar']],
-            kpts[kp2ind['upper_body']['left_collar']],
-            center_up
-            ))
-        
-        right_breast = torch.from_numpy(reflect_point_across_line(
-            kpts[kp2ind['upper_body']['left_collar']],
-            kpts[kp2ind['upper_body']['right_collar']],
-            center_up
-            ))
-        
-        left_pocket = torch.from_numpy(reflect_point_across_line(
-            center_down,
-            center,
-            kpts[kp2ind['upper_body']['left_hem']]
-            ))
-        
-        right_pocket = torch.from_numpy(reflect_point_across_line(
-            center_down,
-            center,
-            kpts[kp2ind['upper_body']['right_hem']]
-            ))
-        
-        left_shoulder= torch.from_numpy(reflect_point_across_line(
-            center_up,
-            left_breast,
-            kpts[kp2ind['upper_body']['left_collar']]
-            ))
-        
-        right_shoulder= torch.from_numpy(reflect_point_across_line(
-            center_up,
-            right_breast,
-            kpts[kp2ind['upper_body']['right_collar']]
-            ))
-        
-
-        kpts = torch.vstack([kpts, center, center_up, center_down, left_breast, right_breast, left_pocket, right_pocket, left_shoulder, right_shoulder])
-
-        return kpts
\ No newline at end of file
+def reflect_points_across_lines(P, A, B):
+    """
+    Batched torch version of reflect_point_across_line.
+
+    P, A, B are tensors of shape (..., 2) representing (x, y) coordinates. Each point in P
+    is reflected across the line formed by the corresponding points in A and B.
+    """
+    x0, y0 = P[..., 0], P[..., 1]
+    x1, y1 = A[..., 0], A[..., 1]
+    x2, y2 = B[..., 0], B[..., 1]
+
+    # Compute line coefficients: ax + by + c = 0
+    a = y2 - y1
+    b = x1 - x2
+    c = x2 * y1 - x1 * y2
+
+    # Compute the reflected points
+    d = (a * x0 + b * y0 + c) / (a**2 + b**2)
+
+    return torch.stack([x0 - 2 * a * d, y0 - 2 * b * d], dim=-1)
+
+def augment_upper_body_kpts(kpts):
+    """
+    Adds nine derived keypoints (center, center up/down, breasts, pockets and shoulders)
+    to the six upper body keypoints.
+
+    Args:
+        kpts: Tensor of shape (6, 2) or (B, 6, 2)
+
+    Returns:
+        kpts: Float tensor of shape (15, 2) or (B, 15, 2)
+    """
+    kpts = kpts.float()
+    ind = kp2ind['upper_body']
+    left_collar, right_collar = kpts[..., ind['left_collar'], :], kpts[..., ind['right_collar'], :]
+    left_hem, right_hem = kpts[..., ind['left_hem'], :], kpts[..., ind['right_hem'], :]
+
+    center = torch.mean(torch.stack([left_collar, right_collar, left_hem, right_hem]), dim=0)
+    center_up = torch.mean(torch.stack([left_collar, right_collar, center]), dim=0)
+    center_down = torch.mean(torch.stack([left_hem, right_hem, center]), dim=0)
+
+    # Breasts and pockets only depend on the points above, reflect them in one go
+    left_breast, right_breast, left_pocket, right_pocket = reflect_points_across_lines(
+        torch.stack([right_collar, left_collar, center_down, center_down]),
+        torch.stack([left_collar, right_collar, center, center]),
+        torch.stack([center_up, center_up, left_hem, right_hem])
+    )
+
+    left_shoulder, right_shoulder = reflect_points_across_lines(
+        torch.stack([center_up, center_up]),
+        torch.stack([left_breast, right_breast]),
+        torch.stack([left_collar, right_collar])
+    )
+
+    derived = torch.stack([center, center_up, center_down, left_breast, right_breast,
+                           left_pocket, right_pocket, left_shoulder, right_shoulder], dim=-2)
+
+    return torch.cat([kpts, derived], dim=-2)